@@ -0,0 +1,357 @@
+import asyncio
+import logging
+import time
+import uuid
+import redis.asyncio as redis
+from collections import OrderedDict
+from typing import Union, Awaitable, Callable
+from app.config import (
+  logger,
+  CACHE_TTL,
+  CACHE_LOCK,
+  CACHE_LOCK_TTL,
+  CACHE_LOCK_WAIT,
+  CACHE_SWR_WINDOW,
+  CACHE_TOMBSTONE_TTL,
+  READ_YOUR_WRITES_WINDOW,
+  L1_CACHE_SIZE,
+  L1_CACHE_TTL,
+  REDIS_URL,
+  REDIS_MAX_CONNECTIONS,
+  REDIS_POOL_TIMEOUT,
+  REDIS_SOCKET_TIMEOUT,
+  REDIS_CONNECT_TIMEOUT,
+  pin_primary,
+)
+from app.metrics import cache_family, record_cache
+
+# SET with a TTL unless the tombstone key (KEYS[2]) changed since the load
+# read it (ARGV[3], empty when there was none): a write landed meanwhile
+SET_UNLESS_TOMBSTONE = """
+if (redis.call('get', KEYS[2]) or '') ~= ARGV[3] then
+  return 0
+end
+redis.call('set', KEYS[1], ARGV[2], 'PX', ARGV[1])
+return 1
+"""
+
+class Cache:
+  _pool: redis.BlockingConnectionPool = None
+  _client: redis.Redis = None
+  _set_unless_tombstone = None
+
+  @classmethod
+  async def init(
+    cls,
+    max_connections: int = REDIS_MAX_CONNECTIONS,
+    pool_timeout: float = REDIS_POOL_TIMEOUT,
+    socket_timeout: float = REDIS_SOCKET_TIMEOUT,
+    connect_timeout: float = REDIS_CONNECT_TIMEOUT,
+  ) -> None:
+    if cls._client is None:
+      cls._pool = redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=max_connections,
+        timeout=pool_timeout,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=connect_timeout,
+      )
+      cls._client = redis.Redis(connection_pool=cls._pool)
+      cls._set_unless_tombstone = cls._client.register_script(SET_UNLESS_TOMBSTONE)
+      logging.info("Redis pool initialized with up to %s connections", max_connections)
+
+  @classmethod
+  async def close(cls):
+    if cls._client:
+      await cls._client.aclose()
+      await cls._pool.disconnect()
+      cls._client = None
+      cls._pool = None
+      logging.info("Redis connection pool closed")
+
+  @classmethod
+  def client(cls) -> redis.Redis:
+    if cls._client is None:
+      raise RuntimeError("Cache not initialized")
+    return cls._client
+
+  @classmethod
+  async def get(cls, key: str) -> Union[bytes, None]:
+    return await cls.client().get(key)
+
+  @classmethod
+  async def setex(
+    cls, key: str, ttl: int, value: bytes,
+    tombstone: Union[str, None] = None, seen: Union[bytes, None] = None
+  ) -> None:
+    """With tombstone, skip the write if that key no longer holds `seen`."""
+    client = cls.client()
+    if tombstone is None:
+      await client.setex(key, ttl, value)
+    else:
+      await cls._set_unless_tombstone(
+        keys=[key, tombstone], args=[int(ttl * 1000), value, seen or b""], client=client
+      )
+
+  @classmethod
+  async def get_with_ttl(cls, key: str) -> tuple[Union[bytes, None], int]:
+    async with cls.client().pipeline(transaction=False) as pipe:
+      pipe.get(key)
+      pipe.pttl(key)
+      value, pttl = await pipe.execute()
+    return value, pttl
+
+  @classmethod
+  async def acquire_lock(cls, key: str, ttl: float) -> bool:
+    return bool(await cls.client().set(f"lock:{key}", "1", nx=True, px=int(ttl * 1000)))
+
+  @classmethod
+  async def release_lock(cls, key: str) -> None:
+    await cls.client().delete(f"lock:{key}")
+
+  @classmethod
+  async def generation(cls, family: str) -> int:
+    gen = await cls.get(f"{family}:gen")
+    return int(gen) if gen is not None else 0
+
+class LocalCache:
+  """
+  Bounded in-process LRU with a per-entry TTL, in front of Redis for the
+  hottest keys. Entries are dropped on pub/sub invalidation; the TTL only
+  bounds staleness if a message is ever missed.
+  """
+  def __init__(self, max_size: int, ttl: float):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._data: OrderedDict = OrderedDict()
+    self._invalidations = 0
+
+  def token(self) -> int:
+    # Take before loading a value; set() with it is skipped if anything was
+    # invalidated meanwhile, so a load racing a write cannot pin stale data
+    return self._invalidations
+
+  def get(self, key: str):
+    entry = self._data.get(key)
+    if entry is None or entry[0] < time.monotonic():
+      if entry is not None:
+        del self._data[key]
+      self.misses += 1
+      return None
+    self._data.move_to_end(key)
+    self.hits += 1
+    return entry[1]
+
+  def set(self, key: str, value, token: Union[int, None] = None) -> None:
+    if token is not None and token != self._invalidations:
+      return
+    self._data[key] = (time.monotonic() + self.ttl, value)
+    self._data.move_to_end(key)
+    while len(self._data) > self.max_size:
+      self._data.popitem(last=False)
+      self.evictions += 1
+
+  def delete(self, key: str) -> None:
+    self._invalidations += 1
+    self._data.pop(key, None)
+
+  def clear(self) -> None:
+    self._invalidations += 1
+    self._data.clear()
+
+  def stats(self) -> dict:
+    return {
+      "size": len(self._data),
+      "max_size": self.max_size,
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+    }
+
+product_l1 = LocalCache(max_size=L1_CACHE_SIZE, ttl=L1_CACHE_TTL)
+
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+async def listen_invalidations() -> None:
+  """
+  Drop L1 entries that any pod (or worker) invalidated. Runs for the life
+  of the app; on reconnect the L1 is cleared, since messages sent while
+  disconnected are lost.
+  """
+  while True:
+    try:
+      async with Cache.client().pubsub() as pubsub:
+        await pubsub.subscribe(INVALIDATION_CHANNEL)
+        product_l1.clear()
+        while True:
+          message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+          if message is not None:
+            product_l1.delete(message["data"].decode())
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.error("Cache invalidation listener failed, retrying: %s", e)
+      await asyncio.sleep(1)
+
+class SingleFlight:
+  """
+  Collapse concurrent loads of the same key in this process into one: the
+  first caller starts the loader in its own task and every caller, the
+  first included, awaits that task. A caller that is cancelled only stops
+  waiting; the load goes on for the others.
+  """
+  def __init__(self):
+    self._inflight: dict[str, asyncio.Task] = {}
+
+  def running(self, key: str) -> bool:
+    return key in self._inflight
+
+  async def do(self, key: str, loader: Callable[[], Awaitable]):
+    task = self._inflight.get(key)
+    if task is None:
+      task = asyncio.create_task(loader())
+      self._inflight[key] = task
+      task.add_done_callback(lambda done: self._finish(key, done))
+    return await asyncio.shield(task)
+
+  def _finish(self, key: str, task: asyncio.Task):
+    if self._inflight.get(key) is task:
+      del self._inflight[key]
+    # Mark a failure retrieved in case every caller had stopped waiting
+    if not task.cancelled():
+      task.exception()
+
+flights = SingleFlight()
+_refreshes: set[asyncio.Task] = set()
+
+async def _fill(key: str, loader: Callable[[], Awaitable], ttl: int):
+  locked = False
+  if CACHE_LOCK:
+    locked = await Cache.acquire_lock(key, CACHE_LOCK_TTL)
+    if not locked:
+      # Another process is loading this key; wait briefly for its result
+      deadline = time.monotonic() + CACHE_LOCK_WAIT
+      while time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        value = await Cache.get(key)
+        if value is not None:
+          return value
+  try:
+    # Each invalidation stamps a new tombstone; if it changes while loading,
+    # the row read may predate that write and is not stored
+    seen = await Cache.get(tombstone_key(key))
+    if written_recently(seen):
+      # A replica may not have that write yet, and its row would be cached
+      pin_primary()
+    value = await loader()
+    if value is not None:
+      await Cache.setex(key, ttl, value, tombstone=tombstone_key(key), seen=seen)
+    return value
+  finally:
+    if locked:
+      await Cache.release_lock(key)
+
+async def _refresh(key: str, loader: Callable[[], Awaitable], ttl: int):
+  try:
+    await flights.do(key, lambda: _fill(key, loader, ttl))
+  except Exception as e:
+    logger.error("Background refresh of %s failed: %s", key, e)
+
+async def get_or_load(key: str, loader: Callable[[], Awaitable], ttl: int = CACHE_TTL):
+  """
+  Read-through cache. `loader` returns the serialized value to cache, or
+  None when there is nothing to cache. Concurrent misses on a key share
+  one load. With CACHE_SWR_WINDOW set, a hit close to expiry is served
+  as-is while one background load refreshes the key.
+  """
+  try:
+    if CACHE_SWR_WINDOW:
+      value, pttl = await Cache.get_with_ttl(key)
+      if value is not None and 0 <= pttl < CACHE_SWR_WINDOW * 1000 and not flights.running(key):
+        task = asyncio.create_task(_refresh(key, loader, ttl))
+        _refreshes.add(task)
+        task.add_done_callback(_refreshes.discard)
+    else:
+      value = await Cache.get(key)
+  except Exception:
+    record_cache(key, "error")
+    raise
+
+  if value is not None:
+    record_cache(key, "hit")
+    logger.info("cache hit")
+    return value
+  record_cache(key, "miss")
+  return await flights.do(key, lambda: _fill(key, loader, ttl))
+
+def tombstone_key(key: str) -> str:
+  # List pages share their family's tombstone, since any write may change them
+  family = cache_family(key)
+  if family in ("products", "orders"):
+    return f"tombstone:{family}"
+  return f"tombstone:{key}"
+
+def new_tombstone() -> str:
+  # Unique per write, and tells when the write happened
+  return f"{time.time_ns()}:{uuid.uuid4().hex[:8]}"
+
+def written_recently(tombstone: Union[bytes, None]) -> bool:
+  if not tombstone:
+    return False
+  written_ns = int(tombstone.split(b":", 1)[0])
+  return time.time_ns() - written_ns < READ_YOUR_WRITES_WINDOW * 1e9
+
+def product_key(productId: str) -> str:
+  return f"product:{productId}"
+
+def order_key(orderId: str) -> str:
+  return f"order:{orderId}"
+
+async def _page_key(family: str, page: int, per_page: int, cursor: Union[str, None]) -> str:
+  gen = await Cache.generation(family)
+  position = f"cursor:{cursor}" if cursor else f"page:{page}"
+  return f"{family}:gen:{gen}:{position}:per_page:{per_page}"
+
+async def products_page_key(page: int, per_page: int, cursor: Union[str, None] = None) -> str:
+  return await _page_key("products", page, per_page, cursor)
+
+async def orders_page_key(page: int, per_page: int, cursor: Union[str, None] = None) -> str:
+  return await _page_key("orders", page, per_page, cursor)
+
+async def _invalidate(family: str, keys: list[str]) -> None:
+  # List pages embed the family generation in their key, so bumping it
+  # orphans every cached page at once; the orphans age out through TTL.
+  # Entity keys are deleted and tombstoned with a fresh value: a load that
+  # read the row before this write could otherwise store it again right
+  # after the DEL. The tombstone has to outlive the longest load, and for
+  # READ_YOUR_WRITES_WINDOW it sends fills of the key to the primary.
+  for key in keys:
+    product_l1.delete(key)
+  tombstone_ttl = int(max(CACHE_TOMBSTONE_TTL, READ_YOUR_WRITES_WINDOW) * 1000)
+  try:
+    async with Cache.client().pipeline(transaction=False) as pipe:
+      if keys:
+        pipe.delete(*keys)
+        for key in keys:
+          pipe.set(tombstone_key(key), new_tombstone(), px=tombstone_ttl)
+          pipe.publish(INVALIDATION_CHANNEL, key)
+      pipe.set(tombstone_key(family), new_tombstone(), px=tombstone_ttl)
+      pipe.incr(f"{family}:gen")
+      await pipe.execute()
+  except Exception as e:
+    logger.error("Failed to invalidate %s cache: %s", family, e)
+
+async def invalidate_product(productId: Union[str, None] = None) -> None:
+  await _invalidate("products", [product_key(productId)] if productId else [])
+
+async def invalidate_products(productIds: list[str]) -> None:
+  await _invalidate("products", [product_key(p) for p in productIds])
+
+async def invalidate_order(orderId: Union[str, None] = None) -> None:
+  await _invalidate("orders", [order_key(orderId)] if orderId else [])
+
+async def invalidate_orders(orderIds: list[str]) -> None:
+  await _invalidate("orders", [order_key(o) for o in orderIds])
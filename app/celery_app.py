@@ -1,8 +1,16 @@
 import os
+import time
+from datetime import datetime
 from celery import Celery
-from celery.signals import worker_process_init, worker_process_shutdown
-from app.config import logger
-import asyncio
+from kombu import Queue
+from prometheus_client import start_http_server
+from celery.signals import (
+    worker_init, worker_process_init, worker_process_shutdown, worker_shutdown,
+    before_task_publish, task_prerun, task_postrun, task_retry,
+)
+from app.config import logger, WORKER_METRICS_PORT, WORKER_PARTITIONS
+from app.metrics import TASK_QUEUE_WAIT, TASK_RUNTIME, TASK_RETRIES
+from app.partitions import ORDER_QUEUE_PREFIX, order_queue, parse_partitions
 
 os.environ.setdefault("FORKED_BY_MULTIPROCESSING", "1")
 redis_url = os.getenv("REDIS_URL","redis://redis:6379/0")
@@ -12,19 +20,74 @@ celery_app = Celery(
   backend= redis_url,
   include= ["app.tasks"]
 )
+# Keep the queue-based JSON logging from app.log instead of Celery's own
+celery_app.conf.worker_hijack_root_logger = False
+
+def route_order(name, args, kwargs, options, task=None, **kw):
+    """Send processOrder to its product's partition queue."""
+    if name != "app.tasks.processOrder":
+        return None
+    productId = kwargs.get("productId") if kwargs else None
+    if productId is None and args and len(args) > 1:
+        productId = args[1]
+    # Tasks queued without a product id stay on the default queue
+    return {"queue": order_queue(productId)} if productId else None
+
+celery_app.conf.task_routes = (route_order,)
+# Without -Q a worker consumes the default queue plus its WORKER_PARTITIONS
+celery_app.conf.task_queues = [Queue(celery_app.conf.task_default_queue)] + [
+    Queue(f"{ORDER_QUEUE_PREFIX}{n}") for n in parse_partitions(WORKER_PARTITIONS)
+]
 
+# Thread and solo pools never send worker_process_init; there the runtime
+# starts lazily on the first task instead.
 @worker_process_init.connect
 def init_worker(**kwargs):
-    from app.config import Database
-    
-    logger.info("Initializing database pool for Celery worker...")
-    asyncio.run(Database.initialize(min_size=2, max_size=5))
-    logger.info("Database pool initialized for Celery worker")
+    from app.runtime import WorkerRuntime
+
+    logger.info("Starting worker runtime for Celery worker process...")
+    WorkerRuntime.start()
 
 @worker_process_shutdown.connect
+@worker_shutdown.connect
 def shutdown_worker(**kwargs):
-    from app.config import Database
-    
-    logger.info("Closing database pool for Celery worker...")
-    asyncio.run(Database.close())
-    logger.info("Database pool closed for Celery worker")
\ No newline at end of file
+    from app.runtime import WorkerRuntime
+
+    logger.info("Stopping worker runtime for Celery worker...")
+    WorkerRuntime.stop()
+
+# Task metrics live in the worker's own registry, served on
+# WORKER_METRICS_PORT. With the prefork pool each child has its own
+# registry, so run the threads pool (as docker-compose does) to scrape them.
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    if WORKER_METRICS_PORT:
+        start_http_server(WORKER_METRICS_PORT)
+        logger.info(f"Worker metrics on :{WORKER_METRICS_PORT}/metrics")
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    # A retry's countdown is not queue wait, so an ETA moves the stamp forward
+    published_at = time.time()
+    if headers.get("eta"):
+        published_at = max(published_at, datetime.fromisoformat(headers["eta"]).timestamp())
+    headers["published_at"] = published_at
+
+_started: dict[str, float] = {}
+
+@task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    _started[task_id] = time.perf_counter()
+    published_at = getattr(task.request, "published_at", None)
+    if published_at:
+        TASK_QUEUE_WAIT.labels(task.name).observe(max(0.0, time.time() - published_at))
+
+@task_postrun.connect
+def record_task_runtime(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is not None:
+        TASK_RUNTIME.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+@task_retry.connect
+def record_task_retry(sender=None, **kwargs):
+    TASK_RETRIES.labels(sender.name).inc()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import time
+from app.config import logger, SSE_TIMEOUT, SSE_KEEPALIVE
+from app.cache import Cache
+from app.services.orders import getOrderStatuses
+
+# The worker publishes every committed status change here as JSON; each
+# API process holds one subscription and fans messages out to its streams.
+ORDER_STATUS_CHANNEL = "order:status"
+FINAL_STATUSES = ("success", "failed", "not_found")
+# Put on every watch when the subscription (re)connects, since messages
+# sent while it was down are lost: the stream re-reads its orders instead
+RESYNC = object()
+
+async def publish_order_statuses(results: list[dict]) -> None:
+  """Publish validation results; call only after their transaction committed."""
+  try:
+    async with Cache.client().pipeline(transaction=False) as pipe:
+      for r in results:
+        pipe.publish(ORDER_STATUS_CHANNEL, json.dumps({"order_id": str(r["order_id"]), "status": r["status"]}))
+      await pipe.execute()
+  except Exception as e:
+    logger.error("Failed to publish order statuses: %s", e)
+
+class OrderWatch:
+  def __init__(self, watchers: "OrderWatchers", orderIds: list[str]):
+    self.orderIds = orderIds
+    self.queue: asyncio.Queue = asyncio.Queue()
+    self._watchers = watchers
+
+  def close(self) -> None:
+    self._watchers.remove(self)
+
+class OrderWatchers:
+  def __init__(self):
+    self._watches: dict[str, set[OrderWatch]] = {}
+
+  def watch(self, orderIds: list[str]) -> OrderWatch:
+    watch = OrderWatch(self, orderIds)
+    for orderId in orderIds:
+      self._watches.setdefault(orderId, set()).add(watch)
+    return watch
+
+  def remove(self, watch: OrderWatch) -> None:
+    for orderId in watch.orderIds:
+      watches = self._watches.get(orderId)
+      if watches is not None:
+        watches.discard(watch)
+        if not watches:
+          del self._watches[orderId]
+
+  def dispatch(self, event: dict) -> None:
+    for watch in self._watches.get(event["order_id"], ()):
+      watch.queue.put_nowait(event)
+
+  def resync(self) -> None:
+    for watch in {w for watches in self._watches.values() for w in watches}:
+      watch.queue.put_nowait(RESYNC)
+
+order_watchers = OrderWatchers()
+
+async def listen_order_statuses() -> None:
+  while True:
+    try:
+      async with Cache.client().pubsub() as pubsub:
+        await pubsub.subscribe(ORDER_STATUS_CHANNEL)
+        order_watchers.resync()
+        while True:
+          message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+          if message is not None:
+            order_watchers.dispatch(json.loads(message["data"]))
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.error("Order status listener failed, retrying: %s", e)
+      await asyncio.sleep(1)
+
+def sse(event: str, data: dict) -> str:
+  return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def watch_orders(orderIds: list[str]) -> tuple[OrderWatch, dict[str, str]]:
+  """
+  Start watching before reading the current statuses, so a change
+  committed in between is either in the read or arrives on the queue.
+  """
+  watch = order_watchers.watch(orderIds)
+  try:
+    return watch, await getOrderStatuses(orderIds)
+  except BaseException:
+    watch.close()
+    raise
+
+async def status_events(watch: OrderWatch, current: dict[str, str]):
+  """
+  One `status` event per order as it is known now, then one per change
+  until every order reached a final status or SSE_TIMEOUT passed (the
+  client's EventSource reconnects). Comments keep idle proxies open.
+  """
+  pending = set(watch.orderIds)
+
+  def emit(orderId: str, status: str):
+    if orderId in pending:
+      if status in FINAL_STATUSES:
+        pending.discard(orderId)
+      return sse("status", {"order_id": orderId, "status": status})
+
+  try:
+    for orderId in watch.orderIds:
+      message = emit(orderId, current.get(orderId, "not_found"))
+      if message:
+        yield message
+
+    deadline = time.monotonic() + SSE_TIMEOUT
+    while pending and (remaining := deadline - time.monotonic()) > 0:
+      try:
+        event = await asyncio.wait_for(watch.queue.get(), min(SSE_KEEPALIVE, remaining))
+      except asyncio.TimeoutError:
+        yield ": keepalive\n\n"
+        continue
+      if event is RESYNC:
+        changed = await getOrderStatuses(list(pending))
+        events = [(o, s) for o, s in changed.items() if s != "pending"]
+      else:
+        events = [(event["order_id"], event["status"])]
+      for orderId, status in events:
+        message = emit(orderId, status)
+        if message:
+          yield message
+  finally:
+    watch.close()
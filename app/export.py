@@ -0,0 +1,46 @@
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+MEDIA_TYPES = {
+  "ndjson": "application/x-ndjson",
+  "csv": "text/csv",
+}
+
+# Rows are flushed to the client in groups to avoid one write per row
+ROWS_PER_WRITE = 500
+
+def plain(value):
+  if isinstance(value, UUID):
+    return str(value)
+  if isinstance(value, Decimal):
+    return int(value)
+  if isinstance(value, datetime):
+    return value.isoformat()
+  return value
+
+async def encode_rows(rows, columns: list[str], format: str):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer) if format == "csv" else None
+  if writer:
+    writer.writerow(columns)
+
+  pending = 0
+  async for row in rows:
+    values = [plain(v) for v in row]
+    if writer:
+      writer.writerow(values)
+    else:
+      buffer.write(json.dumps(dict(zip(columns, values))))
+      buffer.write("\n")
+    pending += 1
+    if pending >= ROWS_PER_WRITE:
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+      pending = 0
+  if buffer.tell():
+    yield buffer.getvalue()
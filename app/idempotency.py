@@ -0,0 +1,39 @@
+import json
+from typing import Union
+from app.config import logger, IDEMPOTENCY_TTL, IDEMPOTENCY_CLAIM_TTL
+from app.cache import Cache
+
+# Stored while the first request with a key is still creating its order
+IN_PROGRESS = b"in-progress"
+
+def idempotency_key(key: str) -> str:
+  return f"idempotency:order:{key}"
+
+async def claim(key: str, ttl: int = IDEMPOTENCY_CLAIM_TTL) -> Union[bytes, None]:
+  """
+  Claim the key for this request with SET NX. Returns None when the claim
+  succeeded, otherwise what the first request stored: IN_PROGRESS or its
+  recorded result. The claim expires after ttl unless complete() replaces
+  it, and a retry after that falls through to the Postgres check.
+  """
+  cache_key = idempotency_key(key)
+  if await Cache.client().set(cache_key, IN_PROGRESS, nx=True, ex=ttl):
+    return None
+  # The claim may expire between the two calls; report it as still running
+  return await Cache.get(cache_key) or IN_PROGRESS
+
+# Failures below are only logged: once the claim expires, the order's
+# unique idempotency_key in Postgres turns a retry into a replay
+
+async def complete(key: str, record: dict, ttl: int = IDEMPOTENCY_TTL) -> None:
+  try:
+    await Cache.setex(idempotency_key(key), ttl, json.dumps(record))
+  except Exception as e:
+    logger.error("Failed to store idempotency key: %s", e)
+
+async def release(key: str) -> None:
+  """Drop a claim whose request failed, so the client can retry."""
+  try:
+    await Cache.client().delete(idempotency_key(key))
+  except Exception as e:
+    logger.error("Failed to release idempotency key: %s", e)
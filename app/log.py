@@ -0,0 +1,87 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+request_id: ContextVar = ContextVar("request_id", default=None)
+order_id: ContextVar = ContextVar("order_id", default=None)
+
+# Per-event messages, matched on their unformatted template, that are only
+# let through at the sample rate
+SAMPLED_MESSAGES = {
+  "cache hit",
+  "Order %s Processed",
+  "Process is finished, your order success",
+}
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+class JsonFormatter(logging.Formatter):
+  def format(self, record: logging.LogRecord) -> str:
+    entry = {
+      "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+      "level": record.levelname,
+      "logger": record.name,
+      "message": record.getMessage(),
+    }
+    for field in ("request_id", "order_id"):
+      value = getattr(record, field, None)
+      if value:
+        entry[field] = value
+    if record.exc_info:
+      entry["exc_info"] = self.formatException(record.exc_info)
+    return json.dumps(entry, default=str)
+
+class ContextQueueHandler(QueueHandler):
+  """
+  Runs in the caller's thread: drops sampled-out records, stamps the
+  request/order ids from the caller's context and enqueues the record
+  unformatted. Formatting and the stderr write happen on the listener.
+  """
+  def __init__(self, log_queue: queue.SimpleQueue, sample_rate: float):
+    super().__init__(log_queue)
+    self.sample_rate = sample_rate
+
+  def filter(self, record: logging.LogRecord):
+    if isinstance(record.msg, str) and record.msg in SAMPLED_MESSAGES and random.random() >= self.sample_rate:
+      return False
+    return super().filter(record)
+
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    record.request_id = request_id.get()
+    record.order_id = order_id.get()
+    return record
+
+_handler: ContextQueueHandler = None
+_listener: QueueListener = None
+
+def setup_logging(level: str = "INFO", format: str = "json", sample_rate: float = 0.01) -> None:
+  global _handler, _listener
+  if _listener is not None:
+    return
+  output = logging.StreamHandler()
+  output.setFormatter(JsonFormatter() if format == "json" else logging.Formatter(TEXT_FORMAT))
+
+  log_queue = queue.SimpleQueue()
+  _handler = ContextQueueHandler(log_queue, sample_rate)
+  root = logging.getLogger()
+  root.handlers = [_handler]
+  root.setLevel(level)
+
+  _listener = QueueListener(log_queue, output, respect_handler_level=True)
+  _listener.start()
+  atexit.register(_listener.stop)
+  # A forked child (e.g. a prefork Celery worker) inherits the queue, with
+  # the parent's undrained records, but not the listener thread
+  os.register_at_fork(after_in_child=_restart_listener)
+
+def _restart_listener() -> None:
+  log_queue = queue.SimpleQueue()
+  _handler.queue = log_queue
+  _listener.queue = log_queue
+  _listener._thread = None
+  _listener.start()
@@ -1,20 +1,101 @@
-from fastapi import FastAPI
-from .config import Database, run_migration
+import asyncio
+import contextlib
+import math
+import time
+import uuid
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from psycopg_pool import PoolTimeout
+from .config import Database, run_migration, pin_primary, DATABASE_REPLICA_URLS, READ_YOUR_WRITES_WINDOW
+from .cache import Cache, listen_invalidations, product_l1
+from .events import listen_order_statuses
 from .routers import products, orders
+from .metrics import MetricsMiddleware, render
+from .log import request_id
 from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-  await Database.init(min_size=5, max_size=10)
+  await Database.init()
+  await Cache.init()
   await run_migration()
+  listeners = [
+    asyncio.create_task(listen_invalidations()),
+    asyncio.create_task(listen_order_statuses()),
+  ]
   yield
+  for listener in listeners:
+    listener.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+      await listener
+  await Cache.close()
   await Database.close()
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(products.router)
 app.include_router(orders.router)
+app.add_middleware(MetricsMiddleware)
+
+# Holds the time until which the client's reads go to the primary
+PRIMARY_COOKIE = "db_primary_until"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+@app.middleware("http")
+async def read_your_writes(request: Request, call_next):
+  try:
+    until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+  except ValueError:
+    until = 0
+  if until > time.time():
+    pin_primary()
+
+  response = await call_next(request)
+  if (
+    DATABASE_REPLICA_URLS
+    and READ_YOUR_WRITES_WINDOW
+    and request.method not in SAFE_METHODS
+    and response.status_code < 400
+  ):
+    response.set_cookie(
+      PRIMARY_COOKIE,
+      f"{time.time() + READ_YOUR_WRITES_WINDOW:.3f}",
+      max_age=math.ceil(READ_YOUR_WRITES_WINDOW),
+      httponly=True
+    )
+  return response
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+  # Every log line written while serving the request carries its id
+  rid = request.headers.get("x-request-id") or uuid.uuid4().hex
+  request_id.set(rid)
+  response = await call_next(request)
+  response.headers["X-Request-ID"] = rid
+  return response
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout(request: Request, exc: PoolTimeout):
+  # Pool starved: fail fast instead of letting requests pile up behind it
+  return JSONResponse(
+    status_code=503,
+    content={"detail": "Database busy, try again later"},
+    headers={"Retry-After": "1"}
+  )
 
 @app.get("/api/v1/health")
 async def health():
   return {"status": "Up and Running!!"}
 
+
+@app.get("/api/v1/health/cache")
+async def cache_health():
+  return {"product_l1": product_l1.stats()}
+
+@app.get("/api/v1/health/db")
+async def db_health():
+  return {"pool": Database.stats()}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+  body, content_type = render()
+  return Response(content=body, media_type=content_type)
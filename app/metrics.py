@@ -0,0 +1,116 @@
+import time
+from functools import wraps
+from prometheus_client import Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from prometheus_client.registry import Collector
+from app.config import Database
+
+# Labels are route templates and key families, never raw paths or keys,
+# so the series count stays fixed and a scrape is a cheap text dump.
+HTTP_REQUESTS = Counter(
+  "http_requests_total", "HTTP requests by route and status",
+  ["method", "route", "status"]
+)
+HTTP_LATENCY = Histogram(
+  "http_request_duration_seconds", "HTTP request latency by route",
+  ["method", "route"]
+)
+CACHE_REQUESTS = Counter(
+  "cache_requests_total", "Cache lookups by key family, tier and result",
+  ["family", "tier", "result"]
+)
+DB_QUERY_LATENCY = Histogram(
+  "db_query_duration_seconds", "Service function latency, connection wait included",
+  ["function"]
+)
+TASK_RUNTIME = Histogram(
+  "celery_task_runtime_seconds", "Celery task run time by task and final state",
+  ["task", "state"]
+)
+TASK_QUEUE_WAIT = Histogram(
+  "celery_task_queue_wait_seconds", "Time from publish (or ETA) to task start",
+  ["task"],
+  buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+)
+TASK_RETRIES = Counter("celery_task_retries_total", "Celery task retries", ["task"])
+
+def cache_family(key: str) -> str:
+  return key.split(":", 1)[0]
+
+def record_cache(key: str, result: str, tier: str = "redis") -> None:
+  CACHE_REQUESTS.labels(cache_family(key), tier, result).inc()
+
+def timed(func):
+  """Observe an async service function's latency under its own name."""
+  histogram = DB_QUERY_LATENCY.labels(func.__name__)
+
+  @wraps(func)
+  async def wrapper(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return await func(*args, **kwargs)
+    finally:
+      histogram.observe(time.perf_counter() - start)
+  return wrapper
+
+class MetricsMiddleware:
+  """
+  Plain ASGI middleware: counts and times every HTTP request under the
+  template of the route that served it ("unmatched" for 404s).
+  """
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      return await self.app(scope, receive, send)
+
+    status = 500
+    async def send_wrapper(message):
+      nonlocal status
+      if message["type"] == "http.response.start":
+        status = message["status"]
+      await send(message)
+
+    start = time.perf_counter()
+    try:
+      await self.app(scope, receive, send_wrapper)
+    finally:
+      route = scope.get("route")
+      path = getattr(route, "path", "unmatched")
+      method = scope["method"]
+      HTTP_LATENCY.labels(method, path).observe(time.perf_counter() - start)
+      HTTP_REQUESTS.labels(method, path, str(status)).inc()
+
+class PoolCollector(Collector):
+  """Reads the Postgres pool stats at scrape time."""
+  def collect(self):
+    stats = Database.stats()
+    if not stats:
+      return
+    connections = GaugeMetricFamily(
+      "db_pool_connections", "Pool connections by state", labels=["pool", "state"]
+    )
+    timeouts = CounterMetricFamily(
+      "db_pool_timeouts", "Connection requests that timed out", labels=["pool"]
+    )
+    pools = [("primary", stats["primary"])]
+    pools += [(f"replica-{i}", replica) for i, replica in enumerate(stats["replicas"])]
+    for name, pool in pools:
+      for state in ("in_use", "idle", "waiting"):
+        connections.add_metric([name, state], pool[state])
+      timeouts.add_metric([name], pool["timeouts"])
+    yield connections
+    yield timeouts
+
+    wait = stats["acquire_wait_seconds"]
+    histogram = HistogramMetricFamily(
+      "db_pool_acquire_wait_seconds", "Time spent waiting for a pool connection"
+    )
+    histogram.add_metric([], buckets=list(wait["buckets"].items()), sum_value=wait["sum"])
+    yield histogram
+
+REGISTRY.register(PoolCollector())
+
+def render() -> tuple[bytes, str]:
+  return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
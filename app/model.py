@@ -1,6 +1,11 @@
-from pydantic import BaseModel, UUID7
-from typing import Union
+from pydantic import BaseModel, UUID7, Field, field_validator
+from dataclasses import dataclass
+from typing import Annotated, Union
 from datetime import datetime
+from uuid import UUID
+
+# Orders of zero or fewer items are the client's error (422)
+Amount = Annotated[int, Field(gt=0)]
 
 class User(BaseModel):
   id: UUID7
@@ -22,17 +27,45 @@ class Product(BaseModel):
   created_at: Union[datetime, None]
 
 class ProductPayload(BaseModel):
-  name: str
-  price: int
-  stock: int
+  # name is VARCHAR(255) and stock an INT; a row outside them is a 422, not a failed write
+  name: str = Field(max_length=255)
+  price: int = Field(ge=0)
+  stock: int = Field(ge=0, le=2**31 - 1)
 
 class OrderPayload(BaseModel):
   product_id: str
-  amount: int
+  amount: Amount
+
+  @field_validator("product_id")
+  @classmethod
+  def canonical_uuid(cls, value: str) -> str:
+    # A malformed id is the client's error (422), not a failed insert
+    return str(UUID(value))
+
+class OrderBatchPayload(BaseModel):
+  items: list[OrderPayload] = Field(min_length=1, max_length=100)
 
 class Order(BaseModel):
   id: UUID7
-  amount: int
+  amount: Amount
+  total_price: int
+  status: str
+  created_at: Union[datetime, None]
+
+# Plain records for rows read back from our own database. They skip model
+# validation; field order matches the SELECT column order they are built from.
+@dataclass(slots=True)
+class ProductRecord:
+  id: UUID
+  name: str
+  price: int
+  stock: int
+  created_at: Union[datetime, None]
+
+@dataclass(slots=True)
+class OrderRecord:
+  id: UUID
+  amount: Amount
   total_price: int
   status: str
-  created_at: Union[datetime, None]
\ No newline at end of file
+  created_at: Union[datetime, None]
@@ -0,0 +1,55 @@
+import asyncio
+from celery import group
+from app.config import (
+  logger, Database,
+  OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_SWEEP_INTERVAL, OUTBOX_SWEEP_AFTER,
+)
+from app.services.orders import relayOrderOutbox, sweepPendingOrders
+from app.tasks import processOrder
+
+# Orders re-enqueued per sweep at most, so a large backlog of slow (not
+# lost) orders is not duplicated wholesale
+SWEEP_LIMIT = 10000
+
+async def publish(orders: list[tuple[str, str]]) -> None:
+  # One group publishes the batch over a single broker connection; Celery's
+  # client is blocking, so it runs off the event loop
+  await asyncio.to_thread(
+    lambda: group(processOrder.s(orderId, productId) for orderId, productId in orders).apply_async()
+  )
+
+async def relay() -> None:
+  """Publish outbox rows in batches; poll only while the outbox is drained."""
+  while True:
+    try:
+      published = await relayOrderOutbox(OUTBOX_BATCH_SIZE, publish)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.error("Outbox relay failed, retrying: %s", e)
+      await asyncio.sleep(1)
+      continue
+    if published < OUTBOX_BATCH_SIZE:
+      await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+async def sweep() -> None:
+  while True:
+    await asyncio.sleep(OUTBOX_SWEEP_INTERVAL)
+    try:
+      swept = await sweepPendingOrders(OUTBOX_SWEEP_AFTER, SWEEP_LIMIT)
+      if swept:
+        logger.warning("Re-enqueued %s orders pending for over %ss", swept, OUTBOX_SWEEP_AFTER)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.error("Pending order sweep failed: %s", e)
+
+async def main() -> None:
+  await Database.init(min_size=1, max_size=2, replicas=False)
+  try:
+    await asyncio.gather(relay(), sweep())
+  finally:
+    await Database.close()
+
+if __name__ == "__main__":
+  asyncio.run(main())
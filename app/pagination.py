@@ -0,0 +1,23 @@
+import base64
+import json
+from datetime import datetime
+from typing import Union
+
+def encode_cursor(created_at: datetime, id) -> str:
+  raw = json.dumps([created_at.isoformat(), str(id)], separators=(",", ":"))
+  return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+  try:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    created_at, id = json.loads(base64.urlsafe_b64decode(padded))
+    return datetime.fromisoformat(created_at), str(id)
+  except Exception:
+    raise ValueError("Invalid cursor")
+
+def next_cursor(items: list, per_page: int) -> Union[str, None]:
+  # A short page means there is nothing after it
+  if len(items) < per_page or not items:
+    return None
+  last = items[-1]
+  return encode_cursor(last.created_at, last.id)
@@ -0,0 +1,41 @@
+import hashlib
+import uuid
+from app.config import ORDER_PARTITIONS
+
+ORDER_QUEUE_PREFIX = "orders."
+
+def jump_hash(key: int, buckets: int) -> int:
+  """
+  Jump consistent hash (Lamping & Veach): going from n to n + 1 buckets
+  moves only 1/(n + 1) of the keys, all of them into the new bucket.
+  """
+  b, j = -1, 0
+  while j < buckets:
+    b = j
+    key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+    j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+  return b
+
+def order_partition(productId: str, partitions: int = ORDER_PARTITIONS) -> int:
+  try:
+    productId = str(uuid.UUID(str(productId)))
+  except ValueError:
+    pass
+  digest = hashlib.blake2b(productId.encode(), digest_size=8).digest()
+  return jump_hash(int.from_bytes(digest, "big"), partitions)
+
+def order_queue(productId: str, partitions: int = ORDER_PARTITIONS) -> str:
+  return f"{ORDER_QUEUE_PREFIX}{order_partition(productId, partitions)}"
+
+def parse_partitions(spec: str, partitions: int = ORDER_PARTITIONS) -> list[int]:
+  """Partitions listed as "0-3,6"; all of them when spec is empty."""
+  if not spec.strip():
+    return list(range(partitions))
+  chosen = set()
+  for part in spec.split(","):
+    start, _, end = part.strip().partition("-")
+    chosen.update(range(int(start), int(end or start) + 1))
+  outside = [n for n in chosen if not 0 <= n < partitions]
+  if outside:
+    raise ValueError(f"Partitions {outside} outside 0-{partitions - 1}")
+  return sorted(chosen)
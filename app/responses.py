@@ -0,0 +1,31 @@
+import gzip
+from fastapi import Request, Response
+from pydantic_core import to_json
+from app.config import CACHE_GZIP_MIN_SIZE
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def encode_body(payload) -> bytes:
+  """
+  Serialize a response body once, with pydantic's Rust encoder, into the
+  bytes that get cached. Large bodies are stored gzipped.
+  """
+  body = to_json(payload)
+  if CACHE_GZIP_MIN_SIZE and len(body) >= CACHE_GZIP_MIN_SIZE:
+    return gzip.compress(body, compresslevel=5)
+  return body
+
+def cached_response(body: bytes, request: Request) -> Response:
+  # Whether a key's body is stored gzipped depends on its size, which can
+  # change, so shared caches must key every cached response on Accept-Encoding
+  vary = {"Vary": "Accept-Encoding"}
+  # JSON never starts with the gzip magic, so the body tells how it was stored
+  if body[:2] != GZIP_MAGIC:
+    return Response(content=body, media_type="application/json", headers=vary)
+  if "gzip" in request.headers.get("accept-encoding", ""):
+    return Response(
+      content=body,
+      media_type="application/json",
+      headers={"Content-Encoding": "gzip", **vary}
+    )
+  return Response(content=gzip.decompress(body), media_type="application/json", headers=vary)
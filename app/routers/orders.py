@@ -1,89 +1,207 @@
 import json
-from app.config import logger, rd
-from fastapi import APIRouter
+import uuid
+from app import idempotency
+from app.config import logger, STOCK_RESERVATION
+from app.cache import get_or_load, order_key, orders_page_key, invalidate_order, invalidate_product, invalidate_products
+from typing import Union, Literal
+from datetime import datetime
+from fastapi import APIRouter, Header, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.exceptions import HTTPException
-from app.tasks import processOrder
-from app.model import OrderPayload, Order
-from app.services.orders import AddOrder, getOrders, getOrderById
+from psycopg_pool import PoolTimeout
+from app.pagination import decode_cursor, next_cursor
+from app.export import encode_rows, MEDIA_TYPES
+from app.responses import encode_body, cached_response
+from app.model import OrderPayload, OrderBatchPayload
+from app.log import order_id
+from app.events import watch_orders, status_events
+from app.services.orders import AddOrder, AddOrders, DuplicateOrder, InsufficientStock, ProductNotFound, getOrders, getOrdersAfter, getOrderById, streamOrders
 
 router = APIRouter(
   prefix="/api/v1/orders",
   tags=["orders"]
 )
 
-def order_to_dict(order: Order) -> dict:
+def created_body(orderId: str) -> dict:
+  if STOCK_RESERVATION:
+    return {
+      "message": "Order created and stock reserved",
+      "order_id": orderId
+    }
   return {
-    "id": str(order.id),
-    "amount": order.amount,
-    "total_price": int(order.total_price),
-    "status": order.status,
-    "created_at": order.created_at.isoformat() if order.created_at else None
+    "message": "Order created and queued for processing",
+    "order_id": orderId
   }
 
-def dict_to_order(od: dict) -> Order:
-  return Order(
-    id=od["id"],
-    amount=od["amount"],
-    total_price=od["total_price"],
-    status=od["status"],
-    created_at=od["created_at"]
-  )
+def order_record(orderId: str, productId: str, amount: int) -> dict:
+  return {"order_id": orderId, "product_id": productId, "amount": amount}
+
+def replay(record: dict, payload: OrderPayload, response: Response) -> dict:
+  """The response of the first request with this key, without writing anything."""
+  if order_record(record["order_id"], payload.product_id, payload.amount) != record:
+    raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different order")
+  response.headers["Idempotent-Replayed"] = "true"
+  return created_body(record["order_id"])
 
 @router.post("/", status_code=201)
-async def add_order(payload: OrderPayload):
+async def add_order(
+  payload: OrderPayload,
+  response: Response,
+  idempotency_key: Union[str, None] = Header(default=None, max_length=255),
+):
+  claimed = completed = False
+  if idempotency_key:
+    try:
+      stored = await idempotency.claim(idempotency_key)
+    except Exception as e:
+      logger.warning("Idempotency store unavailable, relying on Postgres: %s", e)
+    else:
+      if stored == idempotency.IN_PROGRESS:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+      if stored is not None:
+        return replay(json.loads(stored), payload, response)
+      claimed = True
+
   try:
-    res = await AddOrder(payload)
-    processOrder.delay(res)
-    return {
-      "message": "Order created and queued for processing",
-      "order_id": res
-    }
+    res = await AddOrder(payload, reserve=STOCK_RESERVATION, idempotencyKey=idempotency_key)
+    order_id.set(res)
+    await invalidate_order()
+    # Without reservation the outbox row written with the order gets it
+    # queued; the request never waits on the broker
+    if STOCK_RESERVATION:
+      await invalidate_product(payload.product_id)
+    if claimed:
+      await idempotency.complete(idempotency_key, order_record(res, payload.product_id, payload.amount))
+    completed = True
+    return created_body(res)
+  except DuplicateOrder as e:
+    # Redis had lost the key (or was down); Postgres still had the order
+    record = order_record(e.orderId, e.productId, e.amount)
+    if claimed:
+      await idempotency.complete(idempotency_key, record)
+    completed = True
+    return replay(record, payload, response)
+  except InsufficientStock as e:
+    raise HTTPException(status_code=409, detail=f"Insufficient stock: {e}")
+  except ProductNotFound as e:
+    raise HTTPException(status_code=404, detail=str(e))
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error("Failed to insert order")
     raise HTTPException(status_code=500, detail=f"Failed to insert order: {e}")
+  finally:
+    if claimed and not completed:
+      await idempotency.release(idempotency_key)
 
-@router.get("/", status_code=200)
-async def get_orders(page: int = 1, per_page: int = 10):
-  cache_key = f"orders:page:{page}:per_page:{per_page}"
+@router.post("/batch", status_code=201)
+async def add_orders(payload: OrderBatchPayload):
   try:
-    cache_data = rd.get(cache_key)
-    if cache_data is not None:
-      logger.info("cache hit")
-      orders = [dict_to_order(od) for od in json.loads(cache_data)]
+    res = await AddOrders(payload.items, reserve=STOCK_RESERVATION)
+    await invalidate_order()
+    if STOCK_RESERVATION:
+      await invalidate_products(list({item.product_id for item in payload.items}))
       return {
-        "data": orders
+        "message": "Orders created and stock reserved",
+        "order_ids": res
       }
-    data = await getOrders(page=page, per_page=per_page)
-    orders_dict = [order_to_dict(o) for o in data]
-    rd.setex(cache_key, 150, json.dumps(orders_dict))
     return {
-      "data": data
+      "message": "Orders created and queued for processing",
+      "order_ids": res
     }
+  except InsufficientStock as e:
+    raise HTTPException(status_code=409, detail=f"Insufficient stock: {e}")
+  except ProductNotFound as e:
+    raise HTTPException(status_code=404, detail=str(e))
+  except PoolTimeout:
+    raise
+  except Exception as e:
+    logger.error("Failed to insert orders")
+    raise HTTPException(status_code=500, detail=f"Failed to insert orders: {e}")
+
+@router.get("/", status_code=200)
+async def get_orders(request: Request, page: int = 1, per_page: int = 10, cursor: Union[str, None] = None):
+  try:
+    after = decode_cursor(cursor) if cursor else None
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+
+  async def load() -> bytes:
+    if after is not None:
+      data = await getOrdersAfter(created_at=after[0], orderId=after[1], per_page=per_page)
+    else:
+      data = await getOrders(page=page, per_page=per_page)
+    return encode_body({"data": data, "next_cursor": next_cursor(data, per_page)})
+
+  try:
+    cache_key = await orders_page_key(page=page, per_page=per_page, cursor=cursor)
+    return cached_response(await get_or_load(cache_key, load), request)
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error(f"Failed to get product: {e}")
     raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/{orderId}", status_code=200)
-async def get_order_Id(orderId: str):
-  cache_key = f"order:{orderId}"
+@router.get("/export", status_code=200)
+async def export_orders(
+  format: Literal["ndjson", "csv"] = "ndjson",
+  status: Union[Literal["success", "failed", "pending"], None] = None,
+  created_from: Union[datetime, None] = None,
+  created_to: Union[datetime, None] = None,
+):
+  rows = streamOrders(status=status, created_from=created_from, created_to=created_to)
+  columns = ["id", "product_id", "amount", "total_price", "status", "created_at"]
+  return StreamingResponse(
+    encode_rows(rows, columns, format),
+    media_type=MEDIA_TYPES[format],
+    headers={"Content-Disposition": f"attachment; filename=orders.{format}"}
+  )
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+MAX_WATCHED_ORDERS = 100
+
+def parse_order_ids(ids: list[str]) -> list[str]:
   try:
-    cache_data = rd.get(cache_key)
-    if cache_data is not None:
-      logger.info("cache hit")
-      order = dict_to_order(json.loads(cache_data))
-      return {
-        "data": order
-      }
+    return list(dict.fromkeys(str(uuid.UUID(i)) for i in ids))
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Invalid order id")
+
+@router.get("/events", status_code=200)
+async def order_batch_events(ids: str):
+  """Stream status changes of up to 100 comma-separated orders until all are final."""
+  orderIds = parse_order_ids([i for i in ids.split(",") if i])
+  if not 0 < len(orderIds) <= MAX_WATCHED_ORDERS:
+    raise HTTPException(status_code=400, detail=f"Pass 1 to {MAX_WATCHED_ORDERS} order ids")
+  watch, current = await watch_orders(orderIds)
+  return StreamingResponse(status_events(watch, current), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@router.get("/{orderId}/events", status_code=200)
+async def order_events(orderId: str):
+  """Stream the order's status, then its change from pending to success or failed."""
+  orderIds = parse_order_ids([orderId])
+  watch, current = await watch_orders(orderIds)
+  if not current:
+    watch.close()
+    raise HTTPException(status_code=404, detail="Order Not Found")
+  return StreamingResponse(status_events(watch, current), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@router.get("/{orderId}", status_code=200)
+async def get_order_Id(request: Request, orderId: str):
+  cache_key = order_key(orderId)
+
+  async def load():
     data = await getOrderById(orderId=orderId)
+    return encode_body({"data": data}) if data else None
+
+  try:
+    body = await get_or_load(cache_key, load)
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error(f"Failed to get product: {e}")
     raise HTTPException(status_code=500, detail=str(e))
-  
-  if data:
-    order_dict = order_to_dict(data)
-    rd.setex(cache_key, 150, json.dumps(order_dict))
-    return {
-      "data": data
-    }
+
+  if body is not None:
+    return cached_response(body, request)
   else:
     raise HTTPException(status_code=404, detail="Order Not Found")
@@ -1,34 +1,26 @@
+import csv
 import uuid
-import json
-from app.config import rd, logger
-from fastapi import APIRouter
+from pydantic import ValidationError
+from app.config import logger, IMPORT_CHUNK_SIZE
+from app.cache import get_or_load, product_key, products_page_key, invalidate_product, product_l1
+from typing import Union, Literal
+from datetime import datetime
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse
 from fastapi.exceptions import HTTPException
+from psycopg_pool import PoolTimeout
+from app.pagination import decode_cursor, next_cursor
+from app.export import encode_rows, MEDIA_TYPES
+from app.responses import encode_body, cached_response
+from app.metrics import record_cache
 from app.model import Product, ProductPayload
-from app.services.products import addProduct, getProducts, getProductById, deleteProduct, updateProduct
+from app.services.products import addProduct, bulkAddProducts, getProducts, getProductsAfter, getProductById, streamProducts, deleteProduct, updateProduct
 
 router = APIRouter(
   prefix="/api/v1/products",
   tags=["products"]
 )
 
-def product_to_dict(product: Product) -> dict:
-  return {
-    "id": str(product.id),
-    "name": product.name,
-    "price": int(product.price),
-    "stock": product.stock,
-    "created_at": product.created_at.isoformat() if product.created_at else None
-  }
-
-def dict_to_product(pd: dict) -> Product:
-  return Product(
-    id=pd["id"],
-    name=pd["name"],
-    price=pd["price"],
-    stock=pd["stock"],
-    created_at=pd["created_at"]
-  )
-
 @router.post("/", status_code=201)
 async def add_product(product: ProductPayload):
   try:
@@ -41,57 +33,215 @@ async def add_product(product: ProductPayload):
       created_at=None
     )
     res = await addProduct(product=data)
+    await invalidate_product()
     return {
       "message": "Product created successfully",
       "data": res
     }
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error("Failed to insert product")
     raise HTTPException(status_code=500, detail=f"Failed to insert product: {e}")
 
+MAX_ERRORS_PER_CHUNK = 20
+MAX_LINE_BYTES = 64 * 1024
+
+def decode_line(line: bytes) -> Union[str, ValueError]:
+  if len(line) > MAX_LINE_BYTES:
+    return ValueError(f"Line is longer than {MAX_LINE_BYTES} bytes")
+  try:
+    return line.decode().rstrip("\r")
+  except UnicodeDecodeError as e:
+    return e
+
+async def iter_lines(request: Request):
+  # Yields each line, or an error in place of an undecodable or overlong one.
+  # An overlong line is dropped as it streams in, never buffered whole.
+  buffer = b""
+  skipping = False
+  async for chunk in request.stream():
+    buffer += chunk
+    *lines, buffer = buffer.split(b"\n")
+    for line in lines:
+      if skipping:
+        skipping = False
+        continue
+      yield decode_line(line)
+    if len(buffer) > MAX_LINE_BYTES:
+      if not skipping:
+        yield decode_line(buffer)
+        skipping = True
+      buffer = b""
+  if buffer and not skipping:
+    yield decode_line(buffer)
+
+async def iter_records(request: Request, is_csv: bool):
+  # Yields (first line number, record or error). A CSV record keeps taking
+  # lines while a quoted field is open, since it may contain newlines.
+  lineno = start = 0
+  pending = None
+  async for line in iter_lines(request):
+    lineno += 1
+    if isinstance(line, ValueError):
+      yield (lineno if pending is None else start), line
+      pending = None
+    elif not is_csv:
+      yield lineno, line
+    else:
+      if pending is None:
+        start, pending = lineno, line
+      else:
+        pending += "\n" + line
+      if pending.count('"') % 2 == 0:
+        yield start, pending
+        pending = None
+      elif len(pending) > MAX_LINE_BYTES:
+        yield start, ValueError(f"Record is longer than {MAX_LINE_BYTES} bytes")
+        pending = None
+  if pending is not None:
+    yield start, ValueError("Unterminated quoted field")
+
+async def iter_payloads(request: Request):
+  # Yields (line number, payload or error) so a bad row never stops the upload
+  is_csv = request.headers.get("content-type", "").startswith("text/csv")
+  header = None
+  async for lineno, record in iter_records(request, is_csv):
+    if isinstance(record, ValueError):
+      yield lineno, record
+      continue
+    if not record.strip():
+      continue
+    try:
+      if is_csv:
+        row = next(csv.reader([record]))
+        if header is None:
+          header = row
+          continue
+        yield lineno, ProductPayload.model_validate(dict(zip(header, row)))
+      else:
+        yield lineno, ProductPayload.model_validate_json(record)
+    except (ValidationError, ValueError) as e:
+      yield lineno, e
+
+async def flush_chunk(number: int, products: list[Product], invalid: int, errors: list[dict]) -> dict:
+  report = {"chunk": number, "inserted": 0, "invalid": invalid, "errors": errors}
+  if products:
+    try:
+      report["inserted"] = await bulkAddProducts(products=products)
+    except Exception as e:
+      logger.error(f"Failed to import chunk {number}: {e}")
+      report["failed"] = len(products)
+      report["errors"].append({"error": str(e)})
+  return report
+
+@router.post("/bulk", status_code=201)
+async def bulk_add_products(request: Request):
+  """
+  Import products from an NDJSON body (one ProductPayload per line) or a
+  CSV body with a name,price,stock header. Rows are validated as they
+  stream in and a chunk is closed every IMPORT_CHUNK_SIZE rows read, valid
+  or not: its valid rows are written with COPY in their own transaction and
+  only its first MAX_ERRORS_PER_CHUNK errors are kept, so memory stays flat
+  however large (or broken) the upload.
+  """
+  chunks: list[dict] = []
+  products: list[Product] = []
+  errors: list[dict] = []
+  rows = invalid = 0
+  async for lineno, payload in iter_payloads(request):
+    rows += 1
+    if isinstance(payload, Exception):
+      invalid += 1
+      if len(errors) < MAX_ERRORS_PER_CHUNK:
+        errors.append({"line": lineno, "error": str(payload)})
+    else:
+      products.append(Product(
+        id=uuid.uuid7(),
+        name=payload.name,
+        price=payload.price,
+        stock=payload.stock,
+        created_at=None
+      ))
+    if rows >= IMPORT_CHUNK_SIZE:
+      chunks.append(await flush_chunk(len(chunks) + 1, products, invalid, errors))
+      products, errors = [], []
+      rows = invalid = 0
+  if rows:
+    chunks.append(await flush_chunk(len(chunks) + 1, products, invalid, errors))
+
+  inserted = sum(c["inserted"] for c in chunks)
+  if inserted:
+    await invalidate_product()
+  return {
+    "message": "Products imported",
+    "inserted": inserted,
+    "rejected": sum(c["invalid"] + c.get("failed", 0) for c in chunks),
+    "chunks": chunks
+  }
+
 @router.get("/", status_code=200)
-async def get_products(page: int = 1, per_page: int = 10):
-  cache_key = f"products:page:{page}:per_page:{per_page}"
+async def get_products(request: Request, page: int = 1, per_page: int = 10, cursor: Union[str, None] = None):
   try:
-    cache_data = rd.get(cache_key)
-    if cache_data is not None:
-      logger.info("cache hit")
-      products = [dict_to_product(d) for d in json.loads(cache_data)]
-      return {
-        "data": products
-      }
-    data = await getProducts(page=page, per_page=per_page)
-    products_dict = [product_to_dict(p) for p in data]
-    rd.setex(cache_key, 150, json.dumps(products_dict))
-    return {
-      "data": data
-    }
+    after = decode_cursor(cursor) if cursor else None
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+
+  async def load() -> bytes:
+    if after is not None:
+      data = await getProductsAfter(created_at=after[0], productId=after[1], per_page=per_page)
+    else:
+      data = await getProducts(page=page, per_page=per_page)
+    return encode_body({"data": data, "next_cursor": next_cursor(data, per_page)})
+
+  try:
+    cache_key = await products_page_key(page=page, per_page=per_page, cursor=cursor)
+    return cached_response(await get_or_load(cache_key, load), request)
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error(f"Failed to get product: {e}")
     raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/export", status_code=200)
+async def export_products(
+  format: Literal["ndjson", "csv"] = "ndjson",
+  created_from: Union[datetime, None] = None,
+  created_to: Union[datetime, None] = None,
+):
+  rows = streamProducts(created_from=created_from, created_to=created_to)
+  columns = ["id", "name", "stock", "price", "created_at"]
+  return StreamingResponse(
+    encode_rows(rows, columns, format),
+    media_type=MEDIA_TYPES[format],
+    headers={"Content-Disposition": f"attachment; filename=products.{format}"}
+  )
+
 @router.get("/{productId}", status_code=200)
-async def get_product_by_id(productId: str):
-  cache_key = f"product:{productId}"
-  try:
-    cache_data = rd.get(cache_key)
-    if cache_data is not None:
-      logger.info("cache hit")
-      product = dict_to_product(json.loads(cache_data))
-      return {
-        "data": product
-      }
+async def get_product_by_id(request: Request, productId: str):
+  cache_key = product_key(productId)
+  body = product_l1.get(cache_key)
+  if body is not None:
+    record_cache(cache_key, "hit", tier="l1")
+    return cached_response(body, request)
+  record_cache(cache_key, "miss", tier="l1")
+
+  async def load():
     data = await getProductById(productId=productId)
+    return encode_body({"data": data}) if data is not None else None
+
+  token = product_l1.token()
+  try:
+    body = await get_or_load(cache_key, load)
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error(f"Failed to get product: {e}")
     raise HTTPException(status_code=500, detail=str(e))
-  
-  if data is not None:
-    product_dict = product_to_dict(data)
-    rd.setex(cache_key, 150, json.dumps(product_dict))
-    return {
-      "data": data
-    }
+
+  if body is not None:
+    product_l1.set(cache_key, body, token=token)
+    return cached_response(body, request)
   else:
     raise HTTPException(status_code=404, detail="Product Not Found")
 
@@ -106,9 +256,12 @@ async def update_user(productId: str, payload: ProductPayload):
       created_at=None
     )
     await updateProduct(product=data)
+    await invalidate_product(productId)
     return {
       "message": "Product updated successfully"
     }
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error(f"Failed to update user: {e}")
     raise HTTPException(status_code=500, detail=str(e))
@@ -117,9 +270,12 @@ async def update_user(productId: str, payload: ProductPayload):
 async def delete_user(productId: str):
   try:
     await deleteProduct(productId=productId)
+    await invalidate_product(productId)
     return {
       "message": "product deleted successfully"
     }
+  except PoolTimeout:
+    raise
   except Exception as e:
     logger.error(f"Failed to delete user: {e}")
     raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from app.config import logger, Database, WORKER_DB_MIN_SIZE, WORKER_DB_MAX_SIZE, WORKER_CONCURRENCY
+from app.cache import Cache
+
+class WorkerRuntime:
+    """
+    One event loop per worker process, running on its own thread for the
+    life of the process. Task threads submit coroutines to it, so the
+    database and cache pools opened on it are shared by every task instead
+    of being created and torn down per order. At most WORKER_CONCURRENCY
+    submitted coroutines run at once.
+    """
+    _loop: asyncio.AbstractEventLoop = None
+    _thread: threading.Thread = None
+    _lock = threading.Lock()
+    _limit: asyncio.Semaphore = None
+    # key -> [lock, coroutines holding or waiting for it]
+    _keys: dict = {}
+
+    @classmethod
+    def start(cls, min_size: int = WORKER_DB_MIN_SIZE, max_size: int = WORKER_DB_MAX_SIZE):
+        with cls._lock:
+            if cls._loop is not None:
+                return
+            # psycopg's async driver needs a selector loop on Windows
+            loop = asyncio.SelectorEventLoop()
+            thread = threading.Thread(target=loop.run_forever, name="worker-runtime", daemon=True)
+            thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(cls._open(min_size, max_size), loop).result()
+            except BaseException:
+                # Close whichever pool did open and the loop, so the next start begins clean
+                try:
+                    asyncio.run_coroutine_threadsafe(cls._close(), loop).result()
+                except Exception as e:
+                    logger.error("Failed to close worker runtime after failed start: %s", e)
+                cls._limit = None
+                cls._halt(loop, thread)
+                raise
+            cls._loop, cls._thread = loop, thread
+            logger.info("Worker runtime started")
+
+    @classmethod
+    def run(cls, coro, limited: bool = True, key=None):
+        if cls._loop is None:
+            cls.start()
+        if limited:
+            coro = cls.limited(coro)
+        if key is not None:
+            # Outside the slot, so waiting for the key does not hold one
+            coro = cls.serialized(key, coro)
+        return asyncio.run_coroutine_threadsafe(coro, cls._loop).result()
+
+    @classmethod
+    async def serialized(cls, key, coro):
+        """Run coroutines that share a key one at a time, in arrival order."""
+        entry = cls._keys.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await coro
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del cls._keys[key]
+
+    @classmethod
+    async def limited(cls, coro):
+        async with cls._limit:
+            return await coro
+
+    @classmethod
+    def stop(cls):
+        with cls._lock:
+            if cls._loop is None:
+                return
+            loop, thread = cls._loop, cls._thread
+            cls._loop, cls._thread = None, None
+            try:
+                asyncio.run_coroutine_threadsafe(cls._close(), loop).result()
+            finally:
+                cls._halt(loop, thread)
+            logger.info("Worker runtime stopped")
+
+    @staticmethod
+    def _halt(loop: asyncio.AbstractEventLoop, thread: threading.Thread):
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    @classmethod
+    async def _open(cls, min_size: int, max_size: int):
+        cls._limit = asyncio.Semaphore(WORKER_CONCURRENCY)
+        # Tasks only write, so the worker never opens the read replica pools
+        await Database.init(min_size=min_size, max_size=max_size, replicas=False)
+        await Cache.init(max_connections=max_size)
+
+    @staticmethod
+    async def _close():
+        await Cache.close()
+        await Database.close()
@@ -1,128 +1,519 @@
 import uuid
-from app.config import Database
-from app.model import OrderPayload, Order
+from datetime import datetime
+from typing import Union
+from app.config import Database, EXPORT_FETCH_SIZE
+from app.model import OrderPayload, OrderRecord
+from psycopg import AsyncConnection
+from psycopg.rows import args_row
+from psycopg.errors import UniqueViolation
 from app.config import logger
+from app.metrics import timed
 
-async def AddOrder(order: OrderPayload):
+class OrderAlreadyProcessed(ValueError):
+  pass
+
+class InsufficientStock(ValueError):
+  pass
+
+class ProductNotFound(ValueError):
+  pass
+
+class DuplicateOrder(ValueError):
+  """An order with the same idempotency key exists; carries its id, product and amount."""
+  def __init__(self, orderId: str, productId: str, amount: int):
+    super().__init__(f"Order {orderId} already exists for this idempotency key")
+    self.orderId = orderId
+    self.productId = productId
+    self.amount = amount
+
+@timed
+async def AddOrder(order: OrderPayload, reserve: bool = False, idempotencyKey: Union[str, None] = None):
+  """
+  Price and insert the order, and its outbox row for the relay to enqueue,
+  in one prepared statement sent with its COMMIT in a single pipeline
+  flush. With an idempotency key that an earlier order already used,
+  nothing is written and DuplicateOrder is raised instead.
+  """
+  if reserve:
+    return await reserveOrder(order, idempotencyKey)
+  try:
+    async with Database.get_connection() as conn:
+      async with conn.pipeline():
+        async with conn.transaction():
+          async with conn.cursor() as cur:
+            orderId = uuid.uuid7()
+            await cur.execute("""
+              WITH inserted AS (
+                INSERT INTO orders (id, product_id, amount, total_price, status, idempotency_key)
+                SELECT %s, id, %s, price * %s, 'pending', %s FROM products WHERE id = %s
+                ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+                RETURNING id, product_id
+              )
+              INSERT INTO order_outbox (order_id, product_id) SELECT id, product_id FROM inserted
+            """,
+            (orderId, order.amount, order.amount, idempotencyKey, order.product_id,), prepare=True)
+      # rowcount is known once the pipeline has synced
+      if cur.rowcount == 0:
+        existing = await findIdempotentOrder(idempotencyKey, conn) if idempotencyKey else None
+        if existing:
+          raise DuplicateOrder(*existing)
+        raise ProductNotFound(f"Product with ID {order.product_id} not found")
+      return str(orderId)
+  except (DuplicateOrder, ProductNotFound):
+    raise
+  except Exception as e:
+    logger.error("Failed to insert %s", e)
+    raise
+
+@timed
+async def findIdempotentOrder(idempotencyKey: str, conn: Union[AsyncConnection, None] = None) -> Union[tuple, None]:
+  """Callers still holding a connection pass it, so no second one is taken from the pool."""
+  try:
+    if conn is not None:
+      return await _findIdempotentOrder(conn, idempotencyKey)
+    async with Database.get_connection() as conn:
+      return await _findIdempotentOrder(conn, idempotencyKey)
+  except Exception as e:
+    logger.error("Failed to find order by idempotency key %s", e)
+    raise
+
+async def _findIdempotentOrder(conn: AsyncConnection, idempotencyKey: str) -> Union[tuple, None]:
+  async with conn.cursor() as cur:
+    await cur.execute("""
+      SELECT id, product_id, amount FROM orders WHERE idempotency_key = %s;
+    """,
+    (idempotencyKey,), prepare=True)
+    row = await cur.fetchone()
+    return (str(row[0]), str(row[1]), row[2]) if row else None
+
+@timed
+async def reserveOrder(order: OrderPayload, idempotencyKey: Union[str, None] = None) -> str:
+  """
+  Take the stock with one conditional UPDATE and store the order as
+  already successful, so it never needs the worker's row locks. Both
+  happen in one statement; the product is only read back on failure, to
+  raise InsufficientStock right away when it has sold out.
+  """
+  try:
+    async with Database.get_connection() as conn:
+      async with conn.pipeline():
+        async with conn.transaction():
+          async with conn.cursor() as cur:
+            orderId = uuid.uuid7()
+            await cur.execute("""
+              WITH taken AS (
+                UPDATE products SET stock = stock - %s WHERE id = %s AND stock >= %s RETURNING id, price
+              )
+              INSERT INTO orders (id, product_id, amount, total_price, status, idempotency_key)
+              SELECT %s, id, %s, price * %s, 'success', %s FROM taken
+            """,
+            (order.amount, order.product_id, order.amount, orderId, order.amount, order.amount, idempotencyKey,), prepare=True)
+      if cur.rowcount == 1:
+        return str(orderId)
+
+      existing = await findIdempotentOrder(idempotencyKey, conn) if idempotencyKey else None
+      if existing:
+        raise DuplicateOrder(*existing)
+      async with conn.cursor() as cur:
+        await cur.execute("""
+          SELECT stock FROM products WHERE id = %s
+        """,
+        (order.product_id,))
+        product = await cur.fetchone()
+        if product is None:
+          raise ProductNotFound(f"Product with ID {order.product_id} not found")
+        raise InsufficientStock(f"Need {order.amount}, available {product[0]}")
+  except DuplicateOrder:
+    raise
+  except UniqueViolation:
+    # A concurrent request with the same idempotency key won; no ON CONFLICT
+    # here, so the failed insert rolls the stock decrement back with it. Its
+    # connection is back in the pool by now, so the lookup takes a fresh one
+    existing = await findIdempotentOrder(idempotencyKey)
+    if existing is None:
+      raise
+    raise DuplicateOrder(*existing)
+  except (InsufficientStock, ProductNotFound):
+    raise
+  except Exception as e:
+    logger.error("Failed to reserve %s", e)
+    raise
+
+@timed
+async def AddOrders(orders: list[OrderPayload], reserve: bool = False) -> list[str]:
+  """
+  Insert a whole cart in one transaction: one price lookup for every
+  product, one executemany (pipelined by psycopg) for the order rows and
+  one insert for their outbox rows.
+  With reserve, the products are locked in id order and the stock is
+  taken for all items at once, or the whole cart is rejected.
+  """
   try:
     async with Database.get_connection() as conn:
       async with conn.transaction():
         async with conn.cursor() as cur:
-          await cur.execute("""
-              SELECT price FROM products WHERE id = %s
-          """,
-          (order.product_id,))
-          res = await cur.fetchone()
-          
-          total_price = order.amount * res[0]
-          orderId = uuid.uuid7()
-          await conn.execute("""
+          keys = [str(uuid.UUID(order.product_id)) for order in orders]
+          productIds = sorted(set(keys))
+          if reserve:
+            await cur.execute("""
+              SELECT id, price, stock FROM products WHERE id = ANY(%s::uuid[]) ORDER BY id FOR UPDATE
+            """,
+            (productIds,), prepare=True)
+          else:
+            await cur.execute("""
+              SELECT id, price, stock FROM products WHERE id = ANY(%s::uuid[])
+            """,
+            (productIds,), prepare=True)
+          products = {str(row[0]): row for row in await cur.fetchall()}
+
+          missing = [p for p in productIds if p not in products]
+          if missing:
+            raise ProductNotFound(f"Products not found: {', '.join(missing)}")
+
+          if reserve:
+            wanted: dict = {}
+            for key, order in zip(keys, orders):
+              wanted[key] = wanted.get(key, 0) + order.amount
+            short = [p for p, amount in wanted.items() if amount > products[p][2]]
+            if short:
+              raise InsufficientStock(f"Not enough stock for: {', '.join(short)}")
+            await cur.execute("""
+              UPDATE products SET stock = products.stock - v.amount
+              FROM unnest(%s::uuid[], %s::int[]) AS v(id, amount)
+              WHERE products.id = v.id
+            """,
+            (list(wanted.keys()), list(wanted.values()),), prepare=True)
+
+          orderIds = [uuid.uuid7() for _ in orders]
+          await cur.executemany("""
             INSERT INTO orders (id, product_id, amount, total_price, status) VALUES (%s, %s, %s, %s, %s)
           """,
-          (orderId, order.product_id, order.amount, total_price, "pending",))
-          return str(orderId)
+          [
+            (orderId, key, order.amount, order.amount * products[key][1], "success" if reserve else "pending")
+            for orderId, key, order in zip(orderIds, keys, orders)
+          ])
+          if not reserve:
+            await cur.execute("""
+              INSERT INTO order_outbox (order_id, product_id) SELECT * FROM unnest(%s::uuid[], %s::uuid[])
+            """,
+            (orderIds, keys,), prepare=True)
+          return [str(orderId) for orderId in orderIds]
+  except (InsufficientStock, ProductNotFound):
+    raise
+  except Exception as e:
+    logger.error("Failed to insert batch %s", e)
+    raise
+
+@timed
+async def getOrders(page: int, per_page: int) -> list[OrderRecord]:
+  try:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.cursor(row_factory=args_row(OrderRecord)) as cur:
+        offset = (page - 1) * per_page
+        await cur.execute("""
+          SELECT id, amount, total_price::bigint, status, created_at FROM orders ORDER BY created_at DESC, id DESC LIMIT %s OFFSET %s;
+        """,
+        (per_page, offset,), prepare=True)
+        return await cur.fetchall()
+  except Exception as e:
+    logger.error("Failed to get orders %s", e)
+    raise
+
+@timed
+async def getOrdersAfter(created_at: datetime, orderId: str, per_page: int) -> list[OrderRecord]:
+  try:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.cursor(row_factory=args_row(OrderRecord)) as cur:
+        await cur.execute("""
+          SELECT id, amount, total_price::bigint, status, created_at FROM orders
+          WHERE (created_at, id) < (%s, %s)
+          ORDER BY created_at DESC, id DESC LIMIT %s;
+        """,
+        (created_at, orderId, per_page,), prepare=True)
+        return await cur.fetchall()
+  except Exception as e:
+    logger.error("Failed to get orders %s", e)
+    raise
+
+async def streamOrders(
+  status: Union[str, None] = None,
+  created_from: Union[datetime, None] = None,
+  created_to: Union[datetime, None] = None,
+):
+  # Server-side cursor: rows arrive EXPORT_FETCH_SIZE at a time however many match
+  try:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.transaction():
+        async with conn.cursor(name="orders_export") as cur:
+          cur.itersize = EXPORT_FETCH_SIZE
+          await cur.execute("""
+            SELECT id, product_id, amount, total_price, status, created_at FROM orders
+            WHERE (%s::order_status IS NULL OR status = %s::order_status)
+              AND (%s::timestamptz IS NULL OR created_at >= %s)
+              AND (%s::timestamptz IS NULL OR created_at < %s)
+            ORDER BY created_at, id
+          """,
+          (status, status, created_from, created_from, created_to, created_to,))
+          async for row in cur:
+            yield row
+  except Exception as e:
+    logger.error("Failed to export orders %s", e)
+    raise
+
+@timed
+async def getOrderById(orderId: str) -> Union[OrderRecord, None]:
+  try:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.cursor(row_factory=args_row(OrderRecord)) as cur:
+        await cur.execute("""
+          SELECT id, amount, total_price::bigint, status, created_at FROM orders WHERE id = %s;
+        """,
+        (orderId,), prepare=True)
+        return await cur.fetchone()
   except Exception as e:
-    logger.error(f"Failed to insert {e}")
+    logger.error("Failed to get user %s", e)
     raise
 
-async def getOrders(page: int, per_page: int):
+@timed
+async def getOrderStatuses(orderIds: list[str]) -> dict[str, str]:
+  # Primary on purpose: a lagging replica would hide a change already published
   try:
     async with Database.get_connection() as conn:
       async with conn.cursor() as cur:
-        offset = (page - 1) * per_page
         await cur.execute("""
-          SELECT id, amount, total_price, status, created_at FROM orders ORDER BY created_at DESC LIMIT %s OFFSET %s;
+          SELECT id, status FROM orders WHERE id = ANY(%s::uuid[]);
         """,
-        (per_page, offset,))
-        order_data = await cur.fetchall()
-
-        orders: list[Order] = []
-        for data in order_data:
-          orders.append(
-            Order(
-              id = data[0], amount = data[1], total_price = data[2], status = data[3], created_at = data[4]
-            )
-          )
-        return orders
+        (orderIds,), prepare=True)
+        return {str(row[0]): row[1] for row in await cur.fetchall()}
   except Exception as e:
-    logger.error(f"Failed to get orders {e}")
+    logger.error("Failed to get order statuses %s", e)
     raise
 
-async def getOrderById(orderId: str):
+@timed
+async def getPendingOrderIds(limit: int) -> list[str]:
   try:
     async with Database.get_connection() as conn:
       async with conn.cursor() as cur:
         await cur.execute("""
-          SELECT id, amount, total_price, status, created_at FROM orders WHERE id = %s;
+          SELECT id FROM orders WHERE status = 'pending' ORDER BY created_at LIMIT %s;
         """,
-        (orderId,))
-        order_data = await cur.fetchone()
-
-        if order_data:
-          return Order(
-            id = order_data[0], 
-            amount = order_data[1], 
-            total_price = order_data[2], 
-            status = order_data[3], 
-            created_at = order_data[4]
-          )
-        else:
-          return None
+        (limit,), prepare=True)
+        return [str(row[0]) for row in await cur.fetchall()]
   except Exception as e:
-    logger.error(f"Failed to get user {e}")
+    logger.error("Failed to get pending orders %s", e)
     raise
 
-async def validateOrder(orderId: str):
+@timed
+async def getPendingOrderProducts(limit: int, afterId: Union[str, None] = None) -> list[tuple[str, str]]:
+  """Pending (order id, product id) pairs in id order, a page after afterId."""
+  try:
+    async with Database.get_connection() as conn:
+      async with conn.cursor() as cur:
+        await cur.execute("""
+          SELECT id, product_id FROM orders
+          WHERE status = 'pending' AND (%s::uuid IS NULL OR id > %s::uuid)
+          ORDER BY id LIMIT %s;
+        """,
+        (afterId, afterId, limit,), prepare=True)
+        return [(str(row[0]), str(row[1])) for row in await cur.fetchall()]
+  except Exception as e:
+    logger.error("Failed to get pending orders %s", e)
+    raise
+
+@timed
+async def relayOrderOutbox(limit: int, publish) -> int:
+  """
+  Take up to limit outbox rows, oldest first, and await publish with their
+  (order id, product id) pairs. The rows are deleted only if publish
+  returns, in the same transaction, so a failed publish leaves them for the
+  next round; a crash after publishing sends them again. SKIP LOCKED lets
+  several relays share the table.
+  """
   try:
     async with Database.get_connection() as conn:
       async with conn.transaction():
         async with conn.cursor() as cur:
           await cur.execute("""
-              SELECT id, product_id, amount, total_price, status FROM orders WHERE id = %s FOR UPDATE
+            DELETE FROM order_outbox WHERE id IN (
+              SELECT id FROM order_outbox ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            )
+            RETURNING order_id, product_id;
           """,
-          (orderId,))
-          order = await cur.fetchone()
+          (limit,), prepare=True)
+          rows = [(str(row[0]), str(row[1])) for row in await cur.fetchall()]
+          if rows:
+            await publish(rows)
+          return len(rows)
+  except Exception as e:
+    logger.error("Failed to relay order outbox %s", e)
+    raise
+
+@timed
+async def sweepPendingOrders(olderThan: float, limit: int) -> int:
+  """
+  Put orders pending for more than olderThan seconds back in the outbox,
+  unless they are already waiting there. Validating an order twice is a
+  no-op, so a sweep only costs a duplicate task when the order was merely
+  slow.
+  """
+  try:
+    async with Database.get_connection() as conn:
+      async with conn.cursor() as cur:
+        await cur.execute("""
+          INSERT INTO order_outbox (order_id, product_id)
+          SELECT o.id, o.product_id FROM orders o
+          WHERE o.status = 'pending' AND o.created_at < NOW() - make_interval(secs => %s)
+            AND NOT EXISTS (SELECT 1 FROM order_outbox b WHERE b.order_id = o.id)
+          ORDER BY o.created_at LIMIT %s;
+        """,
+        (olderThan, limit,), prepare=True)
+        return cur.rowcount
+  except Exception as e:
+    logger.error("Failed to sweep pending orders %s", e)
+    raise
+
+@timed
+async def validateOrder(orderId: str):
+  """
+  Lock the order, then its product, with two prepared SELECTs, then send
+  the status and stock updates together with the COMMIT in a single
+  pipeline flush. Orders are locked before products, as in
+  validateOrderBatch; a single SELECT ... FOR UPDATE OF o, p would lock
+  them in whatever order the join runs.
+  """
+  try:
+    async with Database.get_connection() as conn:
+      async with conn.pipeline():
+        async with conn.transaction():
+          async with conn.cursor() as cur:
+            await cur.execute("""
+              SELECT product_id, amount, status FROM orders WHERE id = %s FOR UPDATE
+            """,
+            (orderId,), prepare=True)
+            order = await cur.fetchone()
 
-          if not order:
-            raise ValueError("Order not found")
+            if not order:
+              raise ValueError("Order not found")
 
-          if order[4] != "pending":
-            raise (f"Order {orderId} already processed with status {order[4]}")
+            productId, amount, status = order
+            if status != "pending":
+              raise OrderAlreadyProcessed(f"Order {orderId} already processed with status {status}")
 
-          await cur.execute("""
-              SELECT name, stock, price FROM products WHERE id = %s FOR UPDATE
-          """,
-          (order[1],))
-          product = await cur.fetchone()
+            await cur.execute("""
+              SELECT name, stock FROM products WHERE id = %s FOR UPDATE
+            """,
+            (productId,), prepare=True)
+            name, stock = await cur.fetchone()
+
+            if amount > stock:
+              await cur.execute("""
+                UPDATE orders SET status = %s WHERE id = %s
+              """,
+              ("failed", orderId,), prepare=True)
+              return {
+                "order_id": orderId,
+                "status": "failed",
+                "reason": "insufficient_stock",
+                "product_id": str(productId),
+                "product": name,
+                "details": f"Need {amount}, available {stock}",
+              }
+
+            await cur.execute("""
+              UPDATE products SET stock = stock - %s WHERE id = %s
+            """,
+            (amount, productId,), prepare=True)
 
-          if order[2] > product[1]:
             await cur.execute("""
               UPDATE orders SET status = %s WHERE id = %s
             """,
-            ("failed", orderId,))
+            ("success", orderId,), prepare=True)
             return {
               "order_id": orderId,
-              "status": "failed",
-              "reason": "insufficient_stock",
-              "product": product[0], 
-              "details": f"Need {order[2]}, available {product[1]}",
+              "status": "success",
+              "product_id": str(productId),
+              "product": name,
+              "amount": amount
             }
-          
+  except Exception as e:
+    logger.error("Failed to validate: %s", e)
+    raise
+
+@timed
+async def validateOrderBatch(orderIds: Union[list[str], None] = None, limit: int = 100) -> list[dict]:
+  """
+  Validate many pending orders in one transaction, locking each product
+  once. Stock goes to orders oldest first, by id (UUIDv7, so time ordered)
+  among the orders of one cart, which share a created_at; orders that no
+  longer fit are failed with insufficient_stock. Without orderIds the oldest `limit`
+  pending orders are claimed. Rows another worker holds are skipped.
+  """
+  try:
+    async with Database.get_connection() as conn:
+      async with conn.transaction():
+        async with conn.cursor() as cur:
+          # Orders before products, the same lock order validateOrder uses
+          if orderIds is not None:
+            await cur.execute("""
+              SELECT id, product_id, amount FROM orders
+              WHERE id = ANY(%s::uuid[]) AND status = 'pending'
+              ORDER BY created_at, id FOR UPDATE SKIP LOCKED
+            """,
+            (orderIds,), prepare=True)
+          else:
+            await cur.execute("""
+              SELECT id, product_id, amount FROM orders
+              WHERE status = 'pending'
+              ORDER BY created_at, id LIMIT %s FOR UPDATE SKIP LOCKED
+            """,
+            (limit,), prepare=True)
+          orders = await cur.fetchall()
+          if not orders:
+            return []
+
+          productIds = sorted({order[1] for order in orders})
           await cur.execute("""
-              UPDATE products SET stock = stock - %s WHERE id = %s
+            SELECT id, stock FROM products WHERE id = ANY(%s::uuid[]) ORDER BY id FOR UPDATE
           """,
-          (order[2], order[1],))
-          
+          (productIds,), prepare=True)
+          stock = {row[0]: row[1] for row in await cur.fetchall()}
+
+          taken: dict = {}
+          results: list[dict] = []
+          for id, productId, amount in orders:
+            available = stock[productId] - taken.get(productId, 0)
+            if amount > available:
+              results.append({
+                "order_id": str(id),
+                "status": "failed",
+                "reason": "insufficient_stock",
+                "product_id": str(productId),
+                "details": f"Need {amount}, available {available}",
+              })
+            else:
+              taken[productId] = taken.get(productId, 0) + amount
+              results.append({
+                "order_id": str(id),
+                "status": "success",
+                "product_id": str(productId),
+                "amount": amount,
+              })
+
           await cur.execute("""
-              UPDATE orders SET status = %s WHERE id = %s
+            UPDATE orders SET status = v.status
+            FROM unnest(%s::uuid[], %s::order_status[]) AS v(id, status)
+            WHERE orders.id = v.id
           """,
-          ("success", orderId,))
-          return {
-            "order_id": orderId,
-            "status": "success",
-            "product": product[0],
-            "amount": order[2]
-          }
+          ([r["order_id"] for r in results], [r["status"] for r in results],), prepare=True)
+
+          if taken:
+            await cur.execute("""
+              UPDATE products SET stock = products.stock - v.amount
+              FROM unnest(%s::uuid[], %s::int[]) AS v(id, amount)
+              WHERE products.id = v.id
+            """,
+            (list(taken.keys()), list(taken.values()),), prepare=True)
+          return results
   except Exception as e:
-    logger.error(f"Failed to validate: {e}")
-    raise
\ No newline at end of file
+    logger.error("Failed to validate batch: %s", e)
+    raise
@@ -1,8 +1,12 @@
 from app.config import logger
-from app.config import Database
-from app.model import Product
+from app.metrics import timed
+from app.config import Database, EXPORT_FETCH_SIZE
+from app.model import Product, ProductRecord
+from psycopg.rows import args_row
 from typing import Union
+from datetime import datetime
 
+@timed
 async def addProduct(product: Product) -> Product:
   try:
     async with Database.get_connection() as conn:
@@ -20,52 +24,92 @@ async def addProduct(product: Product) -> Product:
           created_at=res[0]
         )
   except Exception as e:
-    logger.error(f"Failed to insert {e}")
+    logger.error("Failed to insert %s", e)
     raise
 
-async def getProducts(page: int, per_page: int) -> list[Product]:
+@timed
+async def bulkAddProducts(products: list[Product]) -> int:
   try:
     async with Database.get_connection() as conn:
-      async with conn.cursor() as cur:
+      async with conn.transaction():
+        async with conn.cursor() as cur:
+          async with cur.copy("COPY products (id, name, stock, price) FROM STDIN") as copy:
+            for product in products:
+              await copy.write_row((product.id, product.name, product.stock, product.price))
+        return len(products)
+  except Exception as e:
+    logger.error("Failed to bulk insert %s", e)
+    raise
+
+@timed
+async def getProducts(page: int, per_page: int) -> list[ProductRecord]:
+  try:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.cursor(row_factory=args_row(ProductRecord)) as cur:
         offset = (page - 1) * per_page
         await cur.execute("""
-          SELECT id, name, stock, price, created_at FROM products ORDER BY created_at DESC LIMIT %s OFFSET %s;
+          SELECT id, name, price::bigint, stock, created_at FROM products ORDER BY created_at DESC, id DESC LIMIT %s OFFSET %s;
         """,
-        (per_page, offset,))
-        product_data = await cur.fetchall()
-
-        products: list[Product] = []
-        for data in product_data:
-          products.append(
-            Product(
-              id=data[0], name=data[1], stock=data[2], price=data[3], created_at=data[4]
-            )
-          )
-        return products
+        (per_page, offset,), prepare=True)
+        return await cur.fetchall()
   except Exception as e:
-    logger.error(f"Failed to insert user {e}")
+    logger.error("Failed to insert user %s", e)
     raise
 
-async def getProductById(productId: str) -> Union[Product,None]:
+@timed
+async def getProductsAfter(created_at: datetime, productId: str, per_page: int) -> list[ProductRecord]:
   try:
-    async with Database.get_connection() as conn:
-      async with conn.cursor() as cur:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.cursor(row_factory=args_row(ProductRecord)) as cur:
         await cur.execute("""
-          SELECT id, name, stock, price, created_at FROM products WHERE id = %s;
+          SELECT id, name, price::bigint, stock, created_at FROM products
+          WHERE (created_at, id) < (%s, %s)
+          ORDER BY created_at DESC, id DESC LIMIT %s;
         """,
-        (productId,))
-        product_data = await cur.fetchone()
+        (created_at, productId, per_page,), prepare=True)
+        return await cur.fetchall()
+  except Exception as e:
+    logger.error("Failed to get products %s", e)
+    raise
 
-        if product_data:
-          return Product(
-            id=product_data[0], name=product_data[1], stock=product_data[2], price=product_data[3], created_at=product_data[4]
-          )
-        else:
-          return None
+async def streamProducts(
+  created_from: Union[datetime, None] = None,
+  created_to: Union[datetime, None] = None,
+):
+  # Server-side cursor: rows arrive EXPORT_FETCH_SIZE at a time however many match
+  try:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.transaction():
+        async with conn.cursor(name="products_export") as cur:
+          cur.itersize = EXPORT_FETCH_SIZE
+          await cur.execute("""
+            SELECT id, name, stock, price, created_at FROM products
+            WHERE (%s::timestamptz IS NULL OR created_at >= %s)
+              AND (%s::timestamptz IS NULL OR created_at < %s)
+            ORDER BY created_at, id
+          """,
+          (created_from, created_from, created_to, created_to,))
+          async for row in cur:
+            yield row
+  except Exception as e:
+    logger.error("Failed to export products %s", e)
+    raise
+
+@timed
+async def getProductById(productId: str) -> Union[ProductRecord, None]:
+  try:
+    async with Database.get_connection(readonly=True) as conn:
+      async with conn.cursor(row_factory=args_row(ProductRecord)) as cur:
+        await cur.execute("""
+          SELECT id, name, price::bigint, stock, created_at FROM products WHERE id = %s;
+        """,
+        (productId,), prepare=True)
+        return await cur.fetchone()
   except Exception as e:
-    logger.error(f"Failed to get user {e}")
+    logger.error("Failed to get user %s", e)
     raise
 
+@timed
 async def updateProduct(product: Product) -> None:
   try:
     async with Database.get_connection() as conn:
@@ -76,14 +120,15 @@ async def updateProduct(product: Product) -> None:
         (product.name, product.stock, product.price, product.id,))
 
         if cur.rowcount == 0:
-          logger.warning(f"No product found with ID: {product.id}")
+          logger.warning("No product found with ID: %s", product.id)
           raise ValueError(f"Product with ID {product.id} not found")
   except ValueError:
     raise
   except Exception as e:
-    logger.error(f"Failed to update user {e}")
+    logger.error("Failed to update user %s", e)
     raise
 
+@timed
 async def deleteProduct(productId: str) -> None:
   try:
     async with Database.get_connection() as conn:
@@ -93,10 +138,10 @@ async def deleteProduct(productId: str) -> None:
         """,
         (productId,))
         if cur.rowcount == 0:
-          logger.warning(f"No product found with ID: {productId}")
+          logger.warning("No product found with ID: %s", productId)
           raise ValueError(f"Product with ID {productId} not found")
   except ValueError:
     raise
   except Exception as e:
-    logger.error(f"Failed to delete user {e}")
+    logger.error("Failed to delete user %s", e)
     raise
\ No newline at end of file
@@ -1,30 +1,126 @@
 import asyncio
+from celery import group
 from .celery_app import celery_app
-from app.services.orders import validateOrder
-from app.config import logger, Database
+from app.services.orders import validateOrder, validateOrderBatch, getPendingOrderIds, getPendingOrderProducts, OrderAlreadyProcessed
+from app.config import logger, ORDER_PROCESS_DELAY, ORDER_PARTITIONS
+from app.partitions import ORDER_QUEUE_PREFIX
+from app.cache import invalidate_order, invalidate_product, invalidate_orders, invalidate_products
+from app.runtime import WorkerRuntime
+from app.log import order_id
+from app.events import publish_order_statuses
 
 @celery_app.task(bind=True, max_retries=3)
-def processOrder(self, orderId: str):
+def processOrder(self, orderId: str, productId: str = None):
+    # The router sent every order of this product here; running them one at
+    # a time keeps them off each other's FOR UPDATE lock and connections
     try:
-        asyncio.run(run(orderId), loop_factory=asyncio.SelectorEventLoop)
+        WorkerRuntime.run(run(orderId), key=productId)
+    except OrderAlreadyProcessed as e:
+        logger.info(str(e))
     except Exception as e:
-        logger.error(f"Order {orderId} processing failed: {e}")
+        logger.error("Order %s processing failed: %s", orderId, e)
         raise self.retry(exc=e, countdown=5)
   
 async def run(orderId: str):
-    await Database.init(min_size=2, max_size=5)
-    
+    # Each run is its own task on the runtime loop, so this stays per order
+    order_id.set(orderId)
     try:
-        logger.info(f"Order {orderId} Processed")
+        logger.info("Order %s Processed", orderId)
         res = await validateOrder(orderId=orderId)
-        await asyncio.sleep(5)
+        await invalidate_order(orderId)
+        await publish_order_statuses([res])
+        if res["status"] == "success":
+            await invalidate_product(res["product_id"])
+        if ORDER_PROCESS_DELAY:
+            await asyncio.sleep(ORDER_PROCESS_DELAY)
         if res["status"] == "failed":
-            logger.error(f"{res["reason"]}: {res["details"]}")
+            logger.error("%s: %s", res["reason"], res["details"])
             logger.info("Process is finished, your order failed")
         elif res["status"] == "success":
             logger.info("Process is finished, your order success")
     except Exception as e:
-        logger.error(f"Order {orderId} validation failed: {e}")
+        logger.error("Order %s validation failed: %s", orderId, e)
         raise
-    finally:
-        await Database.close()
\ No newline at end of file
+
+@celery_app.task
+def drainPendingOrders(batch_size: int = 1000) -> int:
+    """
+    Throughput mode: validate every pending order concurrently on the worker
+    loop, bounded by WORKER_CONCURRENCY, instead of one task per order.
+    """
+    # drain takes its slots per order, so it must not hold one itself
+    return WorkerRuntime.run(drain(batch_size), limited=False)
+
+async def drain(batch_size: int) -> int:
+    processed = 0
+    while True:
+        orderIds = await getPendingOrderIds(limit=batch_size)
+        if not orderIds:
+            break
+        results = await asyncio.gather(
+            *(WorkerRuntime.limited(run(orderId)) for orderId in orderIds),
+            return_exceptions=True
+        )
+        done = sum(1 for r in results if not isinstance(r, Exception) or isinstance(r, OrderAlreadyProcessed))
+        processed += done
+        if done == 0:
+            # Every order in the batch failed; stop instead of spinning on it
+            break
+    logger.info("Drained %s pending orders", processed)
+    return processed
+
+
+@celery_app.task(bind=True, max_retries=3)
+def processPendingBatch(self, batch_size: int = 100) -> int:
+    """
+    Batched variant of processOrder: claim pending orders batch_size at a
+    time and validate each batch in one transaction, locking every product
+    once per batch instead of once per order.
+    """
+    try:
+        return WorkerRuntime.run(run_batches(batch_size))
+    except Exception as e:
+        logger.error("Batch processing failed: %s", e)
+        raise self.retry(exc=e, countdown=5)
+
+async def run_batches(batch_size: int) -> int:
+    processed = 0
+    while True:
+        results = await validateOrderBatch(limit=batch_size)
+        if not results:
+            break
+        processed += len(results)
+        await invalidate_orders([r["order_id"] for r in results])
+        await publish_order_statuses(results)
+        soldProducts = list({r["product_id"] for r in results if r["status"] == "success"})
+        if soldProducts:
+            await invalidate_products(soldProducts)
+        failed = sum(1 for r in results if r["status"] == "failed")
+        logger.info("Validated batch of %s orders, %s failed", len(results), failed)
+    return processed
+
+
+@celery_app.task
+def rebalanceOrders(previous_partitions: int = 0, batch_size: int = 1000) -> int:
+    """
+    Run after ORDER_PARTITIONS changed (with the new value on this worker):
+    drop the queues of partitions that no longer exist and re-enqueue every
+    pending order to its partition under the new count. An order queued
+    twice is validated once; the second run finds it already processed.
+    """
+    with celery_app.connection_for_write() as conn:
+        for n in range(ORDER_PARTITIONS, previous_partitions):
+            purged = conn.default_channel.queue_purge(f"{ORDER_QUEUE_PREFIX}{n}")
+            logger.info("Purged %s tasks from %s%s", purged, ORDER_QUEUE_PREFIX, n)
+
+    requeued = 0
+    afterId = None
+    while True:
+        orders = WorkerRuntime.run(getPendingOrderProducts(batch_size, afterId), limited=False)
+        if not orders:
+            break
+        group(processOrder.s(orderId, productId) for orderId, productId in orders).apply_async()
+        requeued += len(orders)
+        afterId = orders[-1][0]
+    logger.info("Re-enqueued %s pending orders over %s partitions", requeued, ORDER_PARTITIONS)
+    return requeued
@@ -0,0 +1,64 @@
+"""
+CPU cost of serving one cached list page, before and after caching the
+final response bytes.
+
+"model" re-creates the old hit path: json.loads the cached value, build a
+Product per row, then let FastAPI's jsonable_encoder and json.dumps turn
+it back into a body. "bytes" is the current path: hand the cached bytes
+straight to a Response (or gunzip them for clients without gzip). Needs
+no running services.
+
+  python -m bench.cache_hit_path --rows 10 --iterations 20000
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from app.model import Product
+from app.responses import encode_body, cached_response
+
+def request(accept_encoding: str) -> Request:
+  return Request({"type": "http", "headers": [(b"accept-encoding", accept_encoding.encode())]})
+
+def per_request_us(fn, iterations: int) -> float:
+  start = time.perf_counter()
+  for _ in range(iterations):
+    fn()
+  return round((time.perf_counter() - start) / iterations * 1e6, 2)
+
+def main(rows: int, iterations: int):
+  products = [
+    Product(id=uuid.uuid7(), name=f"product {i}", price=10000, stock=100, created_at=datetime.now(timezone.utc))
+    for i in range(rows)
+  ]
+  legacy = json.dumps([
+    {"id": str(p.id), "name": p.name, "price": p.price, "stock": p.stock, "created_at": p.created_at.isoformat()}
+    for p in products
+  ])
+  body = encode_body({"data": products, "next_cursor": None})
+
+  def model_path():
+    data = [Product(**d) for d in json.loads(legacy)]
+    JSONResponse(content=jsonable_encoder({"data": data}))
+
+  gzip_client = request("gzip")
+  plain_client = request("identity")
+
+  print(json.dumps({
+    "rows": rows,
+    "cached_bytes": len(body),
+    "model_us": per_request_us(model_path, iterations),
+    "bytes_us": per_request_us(lambda: cached_response(body, gzip_client), iterations),
+    "bytes_no_gzip_client_us": per_request_us(lambda: cached_response(body, plain_client), iterations),
+  }, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows", type=int, default=10)
+  parser.add_argument("--iterations", type=int, default=20000)
+  args = parser.parse_args()
+  main(args.rows, args.iterations)
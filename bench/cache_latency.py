@@ -0,0 +1,73 @@
+"""
+p99 latency of concurrent cache reads, blocking client vs the async pool.
+
+Simulates the GET handlers: every request does one cache lookup plus a
+short await standing in for the rest of the request, so a blocking call
+stalls every other request in flight on the same event loop. Needs a
+running Redis at REDIS_URL.
+
+  python -m bench.cache_latency --requests 5000 --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import time
+import redis
+from app.cache import Cache
+from app.config import REDIS_URL
+
+KEY = "bench:product:1"
+REST_OF_REQUEST = 0.002
+VALUE = json.dumps({"id": "019b96e9-27af-75a4-a4c8-12755693b966", "name": "bench", "price": 1, "stock": 1})
+
+def percentile(samples: list[float], pct: float) -> float:
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+async def drive(handler, requests: int, concurrency: int) -> dict:
+  latencies: list[float] = []
+  sem = asyncio.Semaphore(concurrency)
+
+  async def one():
+    async with sem:
+      start = time.perf_counter()
+      await handler()
+      latencies.append((time.perf_counter() - start) * 1000)
+
+  start = time.perf_counter()
+  await asyncio.gather(*(one() for _ in range(requests)))
+  elapsed = time.perf_counter() - start
+  return {
+    "req_per_s": round(requests / elapsed, 1),
+    "p50_ms": round(percentile(latencies, 0.50), 3),
+    "p99_ms": round(percentile(latencies, 0.99), 3),
+  }
+
+async def main(requests: int, concurrency: int):
+  blocking = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+  blocking.set(KEY, VALUE)
+
+  async def blocking_handler():
+    blocking.get(KEY)
+    await asyncio.sleep(REST_OF_REQUEST)
+
+  await Cache.init(max_connections=concurrency)
+
+  async def pooled_handler():
+    await Cache.get(KEY)
+    await asyncio.sleep(REST_OF_REQUEST)
+
+  results = {
+    "blocking": await drive(blocking_handler, requests, concurrency),
+    "async_pool": await drive(pooled_handler, requests, concurrency),
+  }
+  await Cache.close()
+  blocking.close()
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--requests", type=int, default=5000)
+  parser.add_argument("--concurrency", type=int, default=200)
+  args = parser.parse_args()
+  asyncio.run(main(args.requests, args.concurrency))
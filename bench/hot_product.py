@@ -0,0 +1,92 @@
+"""
+Hot-product contention: single-order vs batched validation.
+
+Seeds one product with stock for half of --orders pending orders, then
+lets --workers concurrent consumers validate them all, once with
+validateOrder per order and once with validateOrderBatch. Needs a running
+Postgres at DATABASE_URL.
+
+  python -m bench.hot_product --orders 5000 --workers 8 --batch-size 100
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from app.config import Database, run_migration
+from app.services.orders import validateOrder, validateOrderBatch
+
+async def seed(orders: int) -> tuple[uuid.UUID, list[str]]:
+  productId = uuid.uuid7()
+  orderIds = [uuid.uuid7() for _ in range(orders)]
+  async with Database.get_connection() as conn:
+    await conn.execute(
+      "INSERT INTO products (id, name, stock, price) VALUES (%s, %s, %s, %s)",
+      (productId, "bench-hot-product", orders // 2, 1,)
+    )
+    async with conn.cursor() as cur:
+      async with cur.copy("COPY orders (id, product_id, amount, total_price, status) FROM STDIN") as copy:
+        for orderId in orderIds:
+          await copy.write_row((orderId, productId, 1, 1, "pending"))
+  return productId, [str(o) for o in orderIds]
+
+async def cleanup(productId: uuid.UUID) -> dict:
+  async with Database.get_connection() as conn:
+    cur = await conn.execute(
+      "SELECT status::text, COUNT(*) FROM orders WHERE product_id = %s GROUP BY status", (productId,)
+    )
+    statuses = dict(await cur.fetchall())
+    cur = await conn.execute("SELECT stock FROM products WHERE id = %s", (productId,))
+    statuses["stock_left"] = (await cur.fetchone())[0]
+    await conn.execute("DELETE FROM orders WHERE product_id = %s", (productId,))
+    await conn.execute("DELETE FROM products WHERE id = %s", (productId,))
+  return statuses
+
+async def single(orderIds: list[str], workers: int, batch_size: int):
+  queue = list(reversed(orderIds))
+
+  async def worker():
+    while queue:
+      await validateOrder(orderId=queue.pop())
+
+  await asyncio.gather(*(worker() for _ in range(workers)))
+
+async def batched(orderIds: list[str], workers: int, batch_size: int):
+  chunks = [orderIds[i:i + batch_size] for i in range(0, len(orderIds), batch_size)]
+  chunks.reverse()
+
+  async def worker():
+    while chunks:
+      await validateOrderBatch(orderIds=chunks.pop())
+
+  await asyncio.gather(*(worker() for _ in range(workers)))
+
+async def main(orders: int, workers: int, batch_size: int):
+  await Database.init(min_size=workers, max_size=workers + 1)
+  await run_migration()
+  results = {}
+  try:
+    for name, mode in (("single", single), ("batched", batched)):
+      productId, orderIds = await seed(orders)
+      start = time.perf_counter()
+      try:
+        await mode(orderIds, workers, batch_size)
+      finally:
+        elapsed = time.perf_counter() - start
+        outcome = await cleanup(productId)
+      results[name] = {
+        "seconds": round(elapsed, 3),
+        "orders_per_s": round(orders / elapsed, 1),
+        **outcome,
+      }
+    print(json.dumps(results, indent=2))
+  finally:
+    await Database.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--orders", type=int, default=5000)
+  parser.add_argument("--workers", type=int, default=8)
+  parser.add_argument("--batch-size", type=int, default=100)
+  args = parser.parse_args()
+  asyncio.run(main(args.orders, args.workers, args.batch_size))
@@ -0,0 +1,93 @@
+"""
+Page 1 vs deep page latency for GET /orders, OFFSET mode vs cursor mode.
+
+Seeds one product and --orders orders through COPY, times the service
+calls behind both modes and removes the seeded rows afterwards. Needs a
+running Postgres at DATABASE_URL.
+
+  python -m bench.pagination --orders 200000 --page 10000
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from app.config import Database, run_migration
+from app.services.orders import getOrders, getOrdersAfter
+
+PER_PAGE = 10
+
+async def seed(orders: int) -> uuid.UUID:
+  productId = uuid.uuid7()
+  now = datetime.now(timezone.utc)
+  async with Database.get_connection() as conn:
+    await conn.execute(
+      "INSERT INTO products (id, name, stock, price) VALUES (%s, %s, %s, %s)",
+      (productId, "bench-pagination", 0, 1,)
+    )
+    async with conn.cursor() as cur:
+      async with cur.copy("COPY orders (id, product_id, amount, total_price, status, created_at) FROM STDIN") as copy:
+        for i in range(orders):
+          await copy.write_row((uuid.uuid7(), productId, 1, 1, "success", now - timedelta(milliseconds=i)))
+    await conn.execute("ANALYZE orders")
+  return productId
+
+async def cleanup(productId: uuid.UUID) -> None:
+  async with Database.get_connection() as conn:
+    await conn.execute("DELETE FROM orders WHERE product_id = %s", (productId,))
+    await conn.execute("DELETE FROM products WHERE id = %s", (productId,))
+
+async def cursor_before(page: int) -> tuple:
+  # The cursor a client would hold after walking to `page`
+  async with Database.get_connection() as conn:
+    async with conn.cursor() as cur:
+      await cur.execute(
+        "SELECT created_at, id FROM orders ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET %s",
+        ((page - 1) * PER_PAGE - 1,)
+      )
+      return await cur.fetchone()
+
+async def timed(fn, repeat: int) -> float:
+  samples = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    await fn()
+    samples.append((time.perf_counter() - start) * 1000)
+  samples.sort()
+  return round(samples[len(samples) // 2], 3)
+
+async def main(orders: int, page: int, repeat: int):
+  await Database.init(min_size=1, max_size=2)
+  await run_migration()
+  productId = await seed(orders)
+  try:
+    deep_after = await cursor_before(page)
+    results = {
+      "offset": {
+        "page_1_ms": await timed(lambda: getOrders(page=1, per_page=PER_PAGE), repeat),
+        f"page_{page}_ms": await timed(lambda: getOrders(page=page, per_page=PER_PAGE), repeat),
+      },
+      "cursor": {
+        "page_1_ms": await timed(
+          lambda: getOrdersAfter(created_at=datetime.now(timezone.utc) + timedelta(days=1), orderId=str(uuid.UUID(int=0)), per_page=PER_PAGE),
+          repeat
+        ),
+        f"page_{page}_ms": await timed(
+          lambda: getOrdersAfter(created_at=deep_after[0], orderId=deep_after[1], per_page=PER_PAGE),
+          repeat
+        ),
+      },
+    }
+    print(json.dumps(results, indent=2))
+  finally:
+    await cleanup(productId)
+    await Database.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--orders", type=int, default=200000)
+  parser.add_argument("--page", type=int, default=10000)
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+  asyncio.run(main(args.orders, args.page, args.repeat))
@@ -0,0 +1,253 @@
+"""
+End-to-end load test of the order pipeline: HTTP API, Postgres, Redis and
+Celery workers together.
+
+Seeds --products products and --seed-orders historical orders, then
+drives the API with --clients concurrent clients through these phases:
+  create_order      POST /orders for --create orders on random products
+  list_products     GET /products, pages 1..--pages
+  list_orders       GET /orders, pages 1..--pages
+  get_product_hot   GET /products/{id} over --hot-keys ids, repeated
+  get_product_cold  GET /products/{id}, every seeded id once
+  get_order         GET /orders/{id} for the created orders
+Celery workers validate the created orders meanwhile; the run waits until
+none is pending. A sampler polls pg_stat_activity for backends waiting on
+locks the whole time.
+
+The API must be running at --base-url, or pass --serve to start uvicorn.
+Pass --worker-concurrency N to start a Celery worker with N threads and
+the outbox relay, or 0 to rely on ones already running. Rows are removed afterwards unless
+--keep is given. Results go to stdout and, with --output, to a file.
+
+  python -m bench.pipeline --serve --worker-concurrency 64 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+import httpx
+from app.config import Database, run_migration
+
+NAME_PREFIX = "bench-pipeline-"
+LOCK_SAMPLE_INTERVAL = 0.1
+
+def percentile(samples: list[float], pct: float) -> float:
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def summary(latencies: list[float], errors: int, elapsed: float) -> dict:
+  if not latencies:
+    return {"requests": 0, "errors": errors}
+  return {
+    "requests": len(latencies),
+    "errors": errors,
+    "req_per_s": round(len(latencies) / elapsed, 1),
+    "p50_ms": round(percentile(latencies, 0.50), 3),
+    "p95_ms": round(percentile(latencies, 0.95), 3),
+    "p99_ms": round(percentile(latencies, 0.99), 3),
+  }
+
+async def seed(products: int, orders: int, stock: int) -> list[str]:
+  productIds = [uuid.uuid7() for _ in range(products)]
+  now = datetime.now(timezone.utc)
+  async with Database.get_connection() as conn:
+    async with conn.cursor() as cur:
+      async with cur.copy("COPY products (id, name, stock, price) FROM STDIN") as copy:
+        for i, productId in enumerate(productIds):
+          await copy.write_row((productId, f"{NAME_PREFIX}{i}", stock, random.randint(1, 1000)))
+      async with cur.copy("COPY orders (id, product_id, amount, total_price, status, created_at) FROM STDIN") as copy:
+        for i in range(orders):
+          await copy.write_row((uuid.uuid7(), random.choice(productIds), 1, 1, "success", now - timedelta(milliseconds=i)))
+    await conn.execute("ANALYZE products")
+    await conn.execute("ANALYZE orders")
+  return [str(p) for p in productIds]
+
+async def cleanup() -> None:
+  async with Database.get_connection() as conn:
+    for table in ("order_outbox", "orders"):
+      await conn.execute(
+        f"DELETE FROM {table} WHERE product_id IN (SELECT id FROM products WHERE name LIKE %s)", (f"{NAME_PREFIX}%",)
+      )
+    await conn.execute("DELETE FROM products WHERE name LIKE %s", (f"{NAME_PREFIX}%",))
+
+async def order_statuses(orderIds: list[str]) -> dict:
+  async with Database.get_connection() as conn:
+    cur = await conn.execute(
+      "SELECT status::text, COUNT(*) FROM orders WHERE id = ANY(%s::uuid[]) GROUP BY status", (orderIds,)
+    )
+    return dict(await cur.fetchall())
+
+async def sample_lock_waits(stats: dict, stop: asyncio.Event) -> None:
+  # Approximates total lock-wait time as waiting backends x sample interval
+  async with Database.get_connection() as conn:
+    await conn.set_autocommit(True)
+    while not stop.is_set():
+      cur = await conn.execute("""
+        SELECT COUNT(*) FROM pg_stat_activity
+        WHERE wait_event_type = 'Lock' AND datname = current_database()
+      """)
+      waiting = (await cur.fetchone())[0]
+      stats["samples"] += 1
+      stats["waiting_seconds"] += waiting * LOCK_SAMPLE_INTERVAL
+      stats["max_waiting"] = max(stats["max_waiting"], waiting)
+      try:
+        await asyncio.wait_for(stop.wait(), LOCK_SAMPLE_INTERVAL)
+      except asyncio.TimeoutError:
+        pass
+
+async def drive(client: httpx.AsyncClient, requests: list, clients: int, collect=None) -> dict:
+  """Send (method, url, body) requests from `clients` concurrent clients."""
+  latencies: list[float] = []
+  errors = 0
+  queue = list(reversed(requests))
+
+  async def worker():
+    nonlocal errors
+    while queue:
+      method, url, body = queue.pop()
+      start = time.perf_counter()
+      try:
+        response = await client.request(method, url, json=body)
+      except httpx.HTTPError:
+        errors += 1
+        continue
+      latencies.append((time.perf_counter() - start) * 1000)
+      if response.status_code >= 400:
+        errors += 1
+      elif collect:
+        collect(response)
+
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(clients)))
+  return summary(latencies, errors, time.perf_counter() - start)
+
+async def wait_validated(orderIds: list[str], timeout: float) -> dict:
+  deadline = time.monotonic() + timeout
+  while True:
+    statuses = await order_statuses(orderIds)
+    if not statuses.get("pending") or time.monotonic() > deadline:
+      return statuses
+    await asyncio.sleep(0.2)
+
+def start_process(args: list[str], **env) -> subprocess.Popen:
+  return subprocess.Popen([sys.executable, "-m", *args], env={**os.environ, **env})
+
+async def wait_healthy(base_url: str, timeout: float = 30) -> None:
+  deadline = time.monotonic() + timeout
+  async with httpx.AsyncClient(base_url=base_url) as client:
+    while time.monotonic() < deadline:
+      try:
+        if (await client.get("/api/v1/health")).status_code == 200:
+          return
+      except httpx.HTTPError:
+        pass
+      await asyncio.sleep(0.5)
+  raise RuntimeError(f"API at {base_url} did not become healthy")
+
+async def run(args) -> dict:
+  productIds = await seed(args.products, args.seed_orders, args.stock)
+  hot = productIds[:args.hot_keys]
+  created: list[str] = []
+  lock_stats = {"samples": 0, "waiting_seconds": 0.0, "max_waiting": 0}
+  stop = asyncio.Event()
+  sampler = asyncio.create_task(sample_lock_waits(lock_stats, stop))
+
+  limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+  async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30) as client:
+    http = {}
+    pipeline_start = time.perf_counter()
+    http["create_order"] = await drive(
+      client,
+      [("POST", "/api/v1/orders/", {"product_id": random.choice(productIds), "amount": 1}) for _ in range(args.create)],
+      args.clients,
+      collect=lambda response: created.append(response.json()["order_id"]),
+    )
+    pages = range(1, args.pages + 1)
+    http["list_products"] = await drive(client, [("GET", f"/api/v1/products/?page={p}", None) for p in pages], args.clients)
+    http["list_orders"] = await drive(client, [("GET", f"/api/v1/orders/?page={p}", None) for p in pages], args.clients)
+    http["get_product_hot"] = await drive(
+      client, [("GET", f"/api/v1/products/{random.choice(hot)}", None) for _ in range(args.products)], args.clients
+    )
+    http["get_product_cold"] = await drive(client, [("GET", f"/api/v1/products/{p}", None) for p in productIds], args.clients)
+    http["get_order"] = await drive(client, [("GET", f"/api/v1/orders/{o}", None) for o in created], args.clients)
+
+  statuses = await wait_validated(created, args.timeout) if created else {}
+  pipeline_seconds = time.perf_counter() - pipeline_start
+  stop.set()
+  await sampler
+
+  validated = sum(count for status, count in statuses.items() if status != "pending")
+  return {
+    "config": {k: v for k, v in vars(args).items() if k != "output"},
+    "http": http,
+    "pipeline": {
+      "orders_created": len(created),
+      "orders_validated": validated,
+      "statuses": statuses,
+      "seconds": round(pipeline_seconds, 3),
+      "orders_validated_per_s": round(validated / pipeline_seconds, 1),
+    },
+    "lock_wait": {
+      "samples": lock_stats["samples"],
+      "waiting_seconds": round(lock_stats["waiting_seconds"], 3),
+      "max_waiting_backends": lock_stats["max_waiting"],
+    },
+  }
+
+async def main(args):
+  processes: list[subprocess.Popen] = []
+  await Database.init(min_size=2, max_size=2)
+  try:
+    await run_migration()
+    await cleanup()
+    if args.serve:
+      port = args.base_url.rsplit(":", 1)[-1].rstrip("/")
+      processes.append(start_process(["uvicorn", "app.main:app", "--port", port, "--no-access-log"]))
+    if args.worker_concurrency:
+      processes.append(start_process(
+        ["celery", "--app=app.celery_app", "worker", "--pool=threads",
+         f"--concurrency={args.worker_concurrency}", "--loglevel=warning"],
+        WORKER_CONCURRENCY=str(args.worker_concurrency),
+        WORKER_METRICS_PORT="0",
+      ))
+      processes.append(start_process(["app.outbox"]))
+    await wait_healthy(args.base_url)
+
+    results = await run(args)
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+      with open(args.output, "w") as f:
+        f.write(output)
+  finally:
+    for process in processes:
+      process.terminate()
+    for process in processes:
+      process.wait(timeout=30)
+    if not args.keep:
+      await cleanup()
+    await Database.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--base-url", default="http://localhost:8000")
+  parser.add_argument("--serve", action="store_true", help="start uvicorn for the run")
+  parser.add_argument("--worker-concurrency", type=int, default=0, help="start a Celery worker with this many threads and the outbox relay")
+  parser.add_argument("--products", type=int, default=1000)
+  parser.add_argument("--seed-orders", type=int, default=100000)
+  parser.add_argument("--create", type=int, default=5000)
+  parser.add_argument("--stock", type=int, default=1000000)
+  parser.add_argument("--clients", type=int, default=50)
+  parser.add_argument("--pages", type=int, default=200)
+  parser.add_argument("--hot-keys", type=int, default=10)
+  parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for validation")
+  parser.add_argument("--keep", action="store_true", help="keep the seeded rows")
+  parser.add_argument("--output")
+  args = parser.parse_args()
+  asyncio.run(main(args))
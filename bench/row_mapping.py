@@ -0,0 +1,56 @@
+"""
+Cost of mapping fetched rows, pydantic models vs plain records.
+
+Maps --rows tuples shaped like a products SELECT into Product models (the
+old per-row validation) and into ProductRecord (what args_row builds in
+the service layer), then serializes each list the way the routers do.
+Needs no running services.
+
+  python -m bench.row_mapping --rows 10000
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+from pydantic_core import to_json
+from app.model import Product, ProductRecord
+
+def timed_ms(fn, repeat: int) -> float:
+  samples = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    samples.append((time.perf_counter() - start) * 1000)
+  samples.sort()
+  return round(samples[len(samples) // 2], 3)
+
+def main(rows: int, repeat: int):
+  now = datetime.now(timezone.utc)
+  data = [(uuid.uuid7(), f"product {i}", 10000, 100, now) for i in range(rows)]
+
+  def models():
+    return [
+      Product(id=row[0], name=row[1], price=row[2], stock=row[3], created_at=row[4])
+      for row in data
+    ]
+
+  def records():
+    return [ProductRecord(*row) for row in data]
+
+  built_models = models()
+  built_records = records()
+  print(json.dumps({
+    "rows": rows,
+    "pydantic_map_ms": timed_ms(models, repeat),
+    "record_map_ms": timed_ms(records, repeat),
+    "pydantic_serialize_ms": timed_ms(lambda: to_json(built_models), repeat),
+    "record_serialize_ms": timed_ms(lambda: to_json(built_records), repeat),
+  }, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows", type=int, default=10000)
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+  main(args.rows, args.repeat)
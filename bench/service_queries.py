@@ -0,0 +1,115 @@
+"""
+Per-call latency of the order write path, before and after prepared
+statements and pipeline mode.
+
+"text" replays the previous AddOrder/validateOrder (one round trip per
+statement, SQL parsed and planned on every call) with prepared
+statements disabled; "prepared" calls the current services. Each mode
+inserts and validates --orders orders one after another against one
+seeded product, so the numbers are round-trip bound; run it against a
+Postgres across the network (or with added latency) to see the gap
+widen. Needs a running Postgres at DATABASE_URL.
+
+  python -m bench.service_queries --orders 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+import app.config as config
+from app.config import Database, run_migration
+from app.model import OrderPayload
+from app.services.orders import AddOrder, validateOrder
+
+async def text_add_order(order: OrderPayload) -> str:
+  async with Database.get_connection() as conn:
+    async with conn.transaction():
+      async with conn.cursor() as cur:
+        await cur.execute("SELECT price FROM products WHERE id = %s", (order.product_id,))
+        price = (await cur.fetchone())[0]
+        orderId = uuid.uuid7()
+        await cur.execute(
+          "INSERT INTO orders (id, product_id, amount, total_price, status) VALUES (%s, %s, %s, %s, %s)",
+          (orderId, order.product_id, order.amount, order.amount * price, "pending",)
+        )
+        return str(orderId)
+
+async def text_validate_order(orderId: str) -> None:
+  async with Database.get_connection() as conn:
+    async with conn.transaction():
+      async with conn.cursor() as cur:
+        await cur.execute("SELECT product_id, amount, status FROM orders WHERE id = %s FOR UPDATE", (orderId,))
+        productId, amount, _ = await cur.fetchone()
+        await cur.execute("SELECT name, stock, price FROM products WHERE id = %s FOR UPDATE", (productId,))
+        await cur.fetchone()
+        await cur.execute("UPDATE products SET stock = stock - %s WHERE id = %s", (amount, productId,))
+        await cur.execute("UPDATE orders SET status = %s WHERE id = %s", ("success", orderId,))
+
+MODES = {
+  "text": (None, text_add_order, text_validate_order),
+  "prepared": (5, AddOrder, validateOrder),
+}
+
+def summary(samples: list[float]) -> dict:
+  samples.sort()
+  return {
+    "p50_ms": round(samples[len(samples) // 2], 3),
+    "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 3),
+  }
+
+async def seed(orders: int) -> uuid.UUID:
+  productId = uuid.uuid7()
+  async with Database.get_connection() as conn:
+    await conn.execute(
+      "INSERT INTO products (id, name, stock, price) VALUES (%s, %s, %s, %s)",
+      (productId, "bench-service-queries", orders * len(MODES), 1,)
+    )
+  return productId
+
+async def cleanup(productId: uuid.UUID) -> None:
+  async with Database.get_connection() as conn:
+    await conn.execute("DELETE FROM order_outbox WHERE product_id = %s", (productId,))
+    await conn.execute("DELETE FROM orders WHERE product_id = %s", (productId,))
+    await conn.execute("DELETE FROM products WHERE id = %s", (productId,))
+
+async def run_mode(mode: str, productId: uuid.UUID, orders: int) -> dict:
+  threshold, add_order, validate_order = MODES[mode]
+  config.DB_PREPARE_THRESHOLD = threshold
+  await Database.init(min_size=1, max_size=1)
+  try:
+    payload = OrderPayload(product_id=str(productId), amount=1)
+    added, validated = [], []
+    for _ in range(orders):
+      start = time.perf_counter()
+      orderId = await add_order(payload)
+      added.append((time.perf_counter() - start) * 1000)
+
+      start = time.perf_counter()
+      await validate_order(orderId)
+      validated.append((time.perf_counter() - start) * 1000)
+    return {"add_order": summary(added), "validate_order": summary(validated)}
+  finally:
+    await Database.close()
+
+async def main(orders: int):
+  await Database.init(min_size=1, max_size=1)
+  try:
+    await run_migration()
+    productId = await seed(orders)
+  finally:
+    await Database.close()
+
+  try:
+    results = {mode: await run_mode(mode, productId, orders) for mode in MODES}
+    print(json.dumps(results, indent=2))
+  finally:
+    await Database.init(min_size=1, max_size=1)
+    await cleanup(productId)
+    await Database.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--orders", type=int, default=2000)
+  args = parser.parse_args()
+  asyncio.run(main(args.orders))
@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from contextlib import asynccontextmanager
+from httpx import AsyncClient, ASGITransport
+from unittest.mock import patch, AsyncMock
+from app.config import Database
+from app.cache import Cache
+from app.runtime import WorkerRuntime
+
+from app.main import app, PRIMARY_COOKIE
+
+class FakePool:
+  def __init__(self, name: str):
+    self.name = name
+
+  @asynccontextmanager
+  async def connection(self):
+    yield self.name
+
+async def connection_name(readonly: bool = False) -> str:
+  async with Database.get_connection(readonly=readonly) as conn:
+    return conn
+
+@pytest.fixture
+def pools():
+  with patch.object(Database, "_pool", FakePool("primary")), \
+    patch.object(Database, "_replicas", [FakePool("replica-1"), FakePool("replica-2")]), \
+    patch.object(Database, "_next_replica", 0):
+    yield
+
+
+@pytest.mark.anyio
+async def test_readonly_connections_round_robin_replicas(pools):
+  # Each call runs in its own task, like separate requests
+  names = [await asyncio.create_task(connection_name(readonly=True)) for _ in range(3)]
+  assert names == ["replica-1", "replica-2", "replica-1"]
+  assert await asyncio.create_task(connection_name()) == "primary"
+
+
+@pytest.mark.anyio
+async def test_reads_after_write_stay_on_primary(pools):
+  async def write_then_read():
+    await connection_name()
+    return await connection_name(readonly=True)
+
+  assert await asyncio.create_task(write_then_read()) == "primary"
+  assert await asyncio.create_task(connection_name(readonly=True)) == "replica-1"
+
+
+@pytest.mark.anyio
+async def test_readonly_without_replicas_uses_primary():
+  with patch.object(Database, "_pool", FakePool("primary")), \
+    patch.object(Database, "_replicas", []):
+    assert await asyncio.create_task(connection_name(readonly=True)) == "primary"
+
+
+@pytest.mark.anyio
+async def test_write_sets_primary_cookie(pools):
+  with patch("app.main.DATABASE_REPLICA_URLS", ["postgresql://replica"]), \
+    patch("app.routers.products.deleteProduct", new_callable=AsyncMock), \
+    patch("app.routers.products.invalidate_product", new_callable=AsyncMock), \
+    patch("app.routers.products.getProductById", new_callable=AsyncMock) as mock_get_product, \
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
+
+    mock_get.return_value = None
+
+    async def served_by(productId):
+      return await connection_name(readonly=True)
+    mock_get_product.side_effect = served_by
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.delete("/api/v1/products/019b96e9-27af-75a4-a4c8-1275569300db")
+      assert response.status_code == 200
+      assert PRIMARY_COOKIE in response.cookies
+
+      # The follow-up read carries the cookie and is served by the primary
+      response = await ac.get("/api/v1/products/019b96e9-27af-75a4-a4c8-1275569300db")
+      assert response.status_code == 200
+      assert response.json() == {"data": "primary"}
+
+
+def test_worker_runtime_failed_start_cleans_up():
+  with patch.object(Database, "init", new_callable=AsyncMock), \
+    patch.object(Database, "close", new_callable=AsyncMock) as mock_db_close, \
+    patch.object(Cache, "init", new_callable=AsyncMock) as mock_cache_init, \
+    patch.object(Cache, "close", new_callable=AsyncMock):
+    mock_cache_init.side_effect = ConnectionError("redis down")
+    with pytest.raises(ConnectionError):
+      WorkerRuntime.start()
+
+    # The database pool that did open is closed, and nothing is left running
+    mock_db_close.assert_awaited_once()
+    assert WorkerRuntime._loop is None
+    assert WorkerRuntime._limit is None
+
+    # A later start opens a fresh loop
+    mock_cache_init.side_effect = None
+    WorkerRuntime.start()
+    try:
+      assert WorkerRuntime._loop.is_running()
+    finally:
+      WorkerRuntime.stop()
@@ -0,0 +1,39 @@
+import json
+import logging
+import queue
+from app.log import ContextQueueHandler, JsonFormatter, request_id, order_id
+
+def make_record(msg: str, *args) -> logging.LogRecord:
+  return logging.LogRecord("app.test", logging.INFO, __file__, 1, msg, args, None)
+
+
+def test_handler_samples_high_volume_messages():
+  log_queue = queue.SimpleQueue()
+  handler = ContextQueueHandler(log_queue, sample_rate=0)
+
+  handler.handle(make_record("cache hit"))
+  handler.handle(make_record("Failed to validate: %s", "boom"))
+
+  record = log_queue.get_nowait()
+  assert record.msg == "Failed to validate: %s"
+  # Left unformatted for the listener thread
+  assert record.args == ("boom",)
+  assert log_queue.empty()
+
+
+def test_json_output_carries_context_ids():
+  log_queue = queue.SimpleQueue()
+  handler = ContextQueueHandler(log_queue, sample_rate=1)
+  request_token = request_id.set("req-1")
+  order_token = order_id.set("order-1")
+  try:
+    handler.handle(make_record("Order %s Processed", "order-1"))
+  finally:
+    request_id.reset(request_token)
+    order_id.reset(order_token)
+
+  entry = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+  assert entry["message"] == "Order order-1 Processed"
+  assert entry["level"] == "INFO"
+  assert entry["request_id"] == "req-1"
+  assert entry["order_id"] == "order-1"
@@ -1,5 +1,9 @@
 import pytest
+from contextlib import asynccontextmanager
 from httpx import AsyncClient, ASGITransport
+from unittest.mock import patch, AsyncMock
+from psycopg_pool import PoolTimeout
+from app.config import Database, WaitHistogram
 
 from app.main import app
 
@@ -10,4 +14,64 @@ async def test_root():
   ) as ac:
     response = await ac.get("/health")
   assert response.status_code == 200
-  assert response.json() == {"status": "Up and Running!!"}
\ No newline at end of file
+  assert response.json() == {"status": "Up and Running!!"}
+
+
+@pytest.mark.anyio
+async def test_pool_timeout_returns_503():
+  with patch("app.routers.orders.AddOrder", new_callable=AsyncMock) as mock_add_order:
+    mock_add_order.side_effect = PoolTimeout("couldn't get a connection after 5.00 sec")
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000/api/v1/"
+    ) as ac:
+      response = await ac.post("/orders/", json={"product_id": "019b96e9-27af-75a4-a4c8-12755693b966", "amount": 1})
+
+  assert response.status_code == 503
+  assert response.headers["retry-after"] == "1"
+
+
+def test_wait_histogram():
+  histogram = WaitHistogram(buckets=(0.01, 0.1))
+  for seconds in (0.001, 0.01, 0.05, 3):
+    histogram.observe(seconds)
+
+  snapshot = histogram.snapshot()
+  assert snapshot["buckets"] == {"0.01": 2, "0.1": 3, "+Inf": 4}
+  assert snapshot["count"] == 4
+  assert snapshot["sum"] == 3.061
+
+
+@pytest.mark.anyio
+async def test_pool_timeout_is_observed():
+  class StarvedPool:
+    @asynccontextmanager
+    async def connection(self):
+      raise PoolTimeout("couldn't get a connection after 5.00 sec")
+      yield
+
+  histogram = WaitHistogram(buckets=(0.01,))
+  with patch.object(Database, "_pool", StarvedPool()), \
+    patch.object(Database, "_replicas", []), \
+    patch.object(Database, "_acquire_wait", histogram):
+    with pytest.raises(PoolTimeout):
+      async with Database.get_connection():
+        pass
+
+  assert histogram.snapshot()["count"] == 1
+
+
+@pytest.mark.anyio
+async def test_metrics():
+  async with AsyncClient(
+    transport=ASGITransport(app=app), base_url="http://localhost:8000"
+  ) as ac:
+    await ac.get("/api/v1/health")
+    await ac.get("/api/v1/nowhere")
+    response = await ac.get("/metrics")
+
+  assert response.status_code == 200
+  assert response.headers["content-type"].startswith("text/plain")
+  assert 'http_requests_total{method="GET",route="/api/v1/health",status="200"}' in response.text
+  assert 'http_requests_total{method="GET",route="unmatched",status="404"}' in response.text
+  assert 'http_request_duration_seconds_bucket{le="0.005",method="GET",route="/api/v1/health"}' in response.text
@@ -1,8 +1,14 @@
+import asyncio
+import json
 import pytest
 from datetime import datetime
 from httpx import AsyncClient, ASGITransport
 from unittest.mock import patch, AsyncMock
 from app.model import Order
+from app.services.orders import DuplicateOrder, InsufficientStock, ProductNotFound
+from app.events import order_watchers
+from app import idempotency
+from app.config import IDEMPOTENCY_TTL, IDEMPOTENCY_CLAIM_TTL
 
 from app.main import app
 
@@ -11,7 +17,8 @@ async def test_add_order():
   mock_order_id = "order_123"
   
   with patch("app.routers.orders.AddOrder", new_callable=AsyncMock) as mock_add_order, \
-       patch("app.routers.orders.processOrder.delay") as mock_process:
+       patch("app.tasks.processOrder.delay") as mock_process, \
+       patch("app.routers.orders.invalidate_order", new_callable=AsyncMock):
     
     mock_add_order.return_value = mock_order_id
     
@@ -21,7 +28,7 @@ async def test_add_order():
       response = await ac.post(
         "/api/v1/orders/",
         json={
-          "product_id": "prod_123",
+          "product_id": "019b96e9-27af-75a4-a4c8-127556930123",
           "amount": 100
         }
       )
@@ -29,7 +36,7 @@ async def test_add_order():
     assert response.status_code == 201
     assert response.json() == {"message": "Order created and queued for processing", "order_id": "order_123"}
     mock_add_order.assert_called_once()
-    mock_process.assert_called_once_with(mock_order_id)
+    mock_process.assert_not_called()
 
 
 @pytest.mark.anyio
@@ -43,7 +50,7 @@ async def test_add_order_failure():
       response = await ac.post(
         "/api/v1/orders/",
         json={
-          "product_id": "prod_123",
+          "product_id": "019b96e9-27af-75a4-a4c8-127556930123",
           "amount": 100
         }
       )
@@ -52,6 +59,151 @@ async def test_add_order_failure():
     assert "Failed to insert order" in response.json()["detail"]
 
 
+@pytest.mark.anyio
+async def test_add_order_reserved():
+  with patch("app.routers.orders.STOCK_RESERVATION", True), \
+       patch("app.routers.orders.AddOrder", new_callable=AsyncMock) as mock_add_order, \
+       patch("app.routers.orders.invalidate_order", new_callable=AsyncMock), \
+       patch("app.routers.orders.invalidate_product", new_callable=AsyncMock) as mock_invalidate_product:
+
+    mock_add_order.return_value = "order_123"
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/",
+        json={
+          "product_id": "019b96e9-27af-75a4-a4c8-127556930123",
+          "amount": 1
+        }
+      )
+
+    assert response.status_code == 201
+    assert response.json() == {"message": "Order created and stock reserved", "order_id": "order_123"}
+    assert mock_add_order.call_args.kwargs["reserve"] is True
+    mock_invalidate_product.assert_called_once_with("019b96e9-27af-75a4-a4c8-127556930123")
+
+
+@pytest.mark.anyio
+async def test_add_order_sold_out():
+  with patch("app.routers.orders.STOCK_RESERVATION", True), \
+       patch("app.routers.orders.AddOrder", new_callable=AsyncMock) as mock_add_order:
+    mock_add_order.side_effect = InsufficientStock("Need 5, available 0")
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/",
+        json={
+          "product_id": "019b96e9-27af-75a4-a4c8-127556930123",
+          "amount": 5
+        }
+      )
+
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Insufficient stock: Need 5, available 0"
+
+
+@pytest.mark.anyio
+async def test_add_order_idempotent_replay():
+  record = {"order_id": "order_123", "product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 1}
+  with patch("app.routers.orders.idempotency.claim", new_callable=AsyncMock) as mock_claim, \
+       patch("app.routers.orders.AddOrder", new_callable=AsyncMock) as mock_add_order:
+    mock_claim.return_value = json.dumps(record).encode()
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/",
+        json={"product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 1},
+        headers={"Idempotency-Key": "key-1"}
+      )
+
+    assert response.status_code == 201
+    assert response.json() == {"message": "Order created and queued for processing", "order_id": "order_123"}
+    assert response.headers["Idempotent-Replayed"] == "true"
+    mock_claim.assert_called_once_with("key-1")
+    mock_add_order.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_add_order_idempotent_in_progress():
+  with patch("app.routers.orders.idempotency.claim", new_callable=AsyncMock) as mock_claim, \
+       patch("app.routers.orders.AddOrder", new_callable=AsyncMock) as mock_add_order:
+    mock_claim.return_value = b"in-progress"
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/",
+        json={"product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 1},
+        headers={"Idempotency-Key": "key-1"}
+      )
+
+    assert response.status_code == 409
+    mock_add_order.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_add_order_idempotent_key_reused():
+  record = {"order_id": "order_123", "product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 1}
+  with patch("app.routers.orders.idempotency.claim", new_callable=AsyncMock) as mock_claim:
+    mock_claim.return_value = json.dumps(record).encode()
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/",
+        json={"product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 2},
+        headers={"Idempotency-Key": "key-1"}
+      )
+
+    assert response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_add_order_idempotent_duplicate_in_db():
+  with patch("app.routers.orders.idempotency.claim", new_callable=AsyncMock) as mock_claim, \
+       patch("app.routers.orders.idempotency.complete", new_callable=AsyncMock) as mock_complete, \
+       patch("app.routers.orders.idempotency.release", new_callable=AsyncMock) as mock_release, \
+       patch("app.routers.orders.AddOrder", new_callable=AsyncMock) as mock_add_order:
+    mock_claim.return_value = None
+    mock_add_order.side_effect = DuplicateOrder("order_123", "019b96e9-27af-75a4-a4c8-127556930123", 1)
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/",
+        json={"product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 1},
+        headers={"Idempotency-Key": "key-1"}
+      )
+
+    assert response.status_code == 201
+    assert response.json()["order_id"] == "order_123"
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert mock_add_order.call_args.kwargs["idempotencyKey"] == "key-1"
+    mock_complete.assert_called_once_with("key-1", {"order_id": "order_123", "product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 1})
+    mock_release.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_idempotency_claim_expires_before_the_record():
+  client = AsyncMock()
+  client.set.return_value = True
+  with patch("app.idempotency.Cache.client", return_value=client), \
+       patch("app.idempotency.Cache.setex", new_callable=AsyncMock) as mock_setex:
+    assert await idempotency.claim("key-1") is None
+    await idempotency.complete("key-1", {"order_id": "order_123"})
+
+  assert client.set.call_args.kwargs["ex"] == IDEMPOTENCY_CLAIM_TTL
+  assert mock_setex.call_args.args[1] == IDEMPOTENCY_TTL
+
 @pytest.mark.anyio
 async def test_get_orders():
   mock_orders: list[Order] = [
@@ -72,10 +224,11 @@ async def test_get_orders():
   ]
   
   with patch("app.routers.orders.getOrders", new_callable=AsyncMock) as mock_get_orders, \
-    patch("app.routers.orders.rd") as mock_redis:
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
     
     mock_get_orders.return_value = mock_orders
-    mock_redis.get.return_value = None
+    mock_cache_get.return_value = None
     
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
@@ -104,10 +257,11 @@ async def test_get_order_by_id():
   )
   
   with patch("app.routers.orders.getOrderById", new_callable=AsyncMock) as mock_get_order, \
-    patch("app.routers.orders.rd") as mock_redis:
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
 
     mock_get_order.return_value = mock_order
-    mock_redis.get.return_value = None
+    mock_cache_get.return_value = None
     
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
@@ -126,10 +280,11 @@ async def test_get_order_by_id():
 @pytest.mark.anyio
 async def test_get_order_by_id_not_found():
    with patch("app.routers.orders.getOrderById", new_callable=AsyncMock) as mock_get_order, \
-    patch("app.routers.orders.rd") as mock_redis:
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
     
     mock_get_order.return_value = None
-    mock_redis.get.return_value = None
+    mock_cache_get.return_value = None
     
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
@@ -137,4 +292,190 @@ async def test_get_order_by_id_not_found():
       response = await ac.get("/api/v1/orders/nonexistent_id")
     
     assert response.status_code == 404
-    assert response.json()["detail"] == "Order Not Found"
\ No newline at end of file
+    assert response.json()["detail"] == "Order Not Found"
+
+@pytest.mark.anyio
+async def test_export_orders():
+  created_at = datetime(2025, 1, 8, 10, 0, 0)
+  calls = []
+
+  async def mock_stream(**kwargs):
+    calls.append(kwargs)
+    yield ("019b96e9-27af-75a4-a4c8-12755693b966", "019b9605-51cb-763f-bfdd-db992540da8a", 2, 200, "success", created_at)
+    yield ("019b96eb-305c-7a51-b17a-e61f301a65e3", "019b9605-51cb-763f-bfdd-db992540da8a", 1, 100, "success", created_at)
+
+  with patch("app.routers.orders.streamOrders", new=mock_stream):
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      ndjson = await ac.get("/api/v1/orders/export?status=success")
+      csv = await ac.get("/api/v1/orders/export?format=csv")
+
+  assert ndjson.status_code == 200
+  assert ndjson.headers["content-type"] == "application/x-ndjson"
+  lines = ndjson.text.strip().split("\n")
+  assert len(lines) == 2
+  assert json.loads(lines[0])["total_price"] == 200
+  assert json.loads(lines[0])["created_at"] == created_at.isoformat()
+  assert calls[0]["status"] == "success"
+
+  assert csv.status_code == 200
+  rows = csv.text.strip().splitlines()
+  assert rows[0] == "id,product_id,amount,total_price,status,created_at"
+  assert len(rows) == 3
+
+
+@pytest.mark.anyio
+async def test_add_orders_batch():
+  mock_order_ids = ["order_1", "order_2"]
+
+  with patch("app.routers.orders.AddOrders", new_callable=AsyncMock) as mock_add_orders, \
+       patch("app.routers.orders.invalidate_order", new_callable=AsyncMock):
+
+    mock_add_orders.return_value = mock_order_ids
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/batch",
+        json={
+          "items": [
+            {"product_id": "019b96e9-27af-75a4-a4c8-127556930001", "amount": 2},
+            {"product_id": "019b96e9-27af-75a4-a4c8-127556930002", "amount": 1}
+          ]
+        }
+      )
+
+    assert response.status_code == 201
+    assert response.json() == {"message": "Orders created and queued for processing", "order_ids": mock_order_ids}
+    items = mock_add_orders.call_args.args[0]
+    assert [i.product_id for i in items] == ["019b96e9-27af-75a4-a4c8-127556930001", "019b96e9-27af-75a4-a4c8-127556930002"]
+
+
+@pytest.mark.anyio
+async def test_add_orders_batch_empty():
+  async with AsyncClient(
+    transport=ASGITransport(app=app), base_url="http://localhost:8000"
+  ) as ac:
+    response = await ac.post("/api/v1/orders/batch", json={"items": []})
+
+  assert response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_add_orders_batch_invalid_product_id():
+  with patch("app.routers.orders.AddOrders", new_callable=AsyncMock) as mock_add_orders:
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/batch",
+        json={"items": [{"product_id": "not-a-uuid", "amount": 1}]}
+      )
+
+    assert response.status_code == 422
+    mock_add_orders.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_add_orders_batch_non_positive_amount():
+  with patch("app.routers.orders.AddOrders", new_callable=AsyncMock) as mock_add_orders:
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/batch",
+        json={"items": [{"product_id": "019b96e9-27af-75a4-a4c8-127556930123", "amount": 0}]}
+      )
+
+    assert response.status_code == 422
+    mock_add_orders.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_add_orders_batch_unknown_product():
+  with patch("app.routers.orders.AddOrders", new_callable=AsyncMock) as mock_add_orders:
+    mock_add_orders.side_effect = ProductNotFound("Products not found: 019b96e9-27af-75a4-a4c8-127556930001")
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/orders/batch",
+        json={"items": [{"product_id": "019b96e9-27af-75a4-a4c8-127556930001", "amount": 1}]}
+      )
+
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Products not found: 019b96e9-27af-75a4-a4c8-127556930001"
+
+
+def sse_events(body: str) -> list[dict]:
+  return [
+    json.loads(block.split("data: ", 1)[1])
+    for block in body.strip().split("\n\n")
+    if block.startswith("event: status")
+  ]
+
+
+@pytest.mark.anyio
+async def test_order_events_stream_status_change():
+  orderId = "019b96e9-27af-75a4-a4c8-12755693b966"
+
+  async def publish_when_watched():
+    while orderId not in order_watchers._watches:
+      await asyncio.sleep(0.01)
+    order_watchers.dispatch({"order_id": orderId, "status": "success"})
+
+  with patch("app.events.getOrderStatuses", new_callable=AsyncMock) as mock_statuses:
+    mock_statuses.return_value = {orderId: "pending"}
+    publisher = asyncio.create_task(publish_when_watched())
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.get(f"/api/v1/orders/{orderId}/events")
+    await publisher
+
+  assert response.status_code == 200
+  assert response.headers["content-type"].startswith("text/event-stream")
+  assert sse_events(response.text) == [
+    {"order_id": orderId, "status": "pending"},
+    {"order_id": orderId, "status": "success"},
+  ]
+  assert orderId not in order_watchers._watches
+
+
+@pytest.mark.anyio
+async def test_order_events_not_found():
+  with patch("app.events.getOrderStatuses", new_callable=AsyncMock) as mock_statuses:
+    mock_statuses.return_value = {}
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.get("/api/v1/orders/019b96e9-27af-75a4-a4c8-12755693b966/events")
+
+  assert response.status_code == 404
+  assert order_watchers._watches == {}
+
+
+@pytest.mark.anyio
+async def test_order_batch_events():
+  done = "019b96e9-27af-75a4-a4c8-12755693b966"
+  missing = "019b96e9-27af-75a4-a4c8-12755693b967"
+
+  with patch("app.events.getOrderStatuses", new_callable=AsyncMock) as mock_statuses:
+    mock_statuses.return_value = {done: "failed"}
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.get(f"/api/v1/orders/events?ids={done},{missing},{done}")
+      invalid = await ac.get("/api/v1/orders/events?ids=not-a-uuid")
+
+  assert sse_events(response.text) == [
+    {"order_id": done, "status": "failed"},
+    {"order_id": missing, "status": "not_found"},
+  ]
+  assert invalid.status_code == 400
@@ -0,0 +1,27 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock
+from app import outbox
+
+
+@pytest.mark.anyio
+async def test_publish_sends_one_group():
+  with patch("app.outbox.group") as mock_group:
+    await outbox.publish([("order_1", "prod_1"), ("order_2", "prod_2")])
+
+  signatures = list(mock_group.call_args.args[0])
+  assert [s.args for s in signatures] == [("order_1", "prod_1"), ("order_2", "prod_2")]
+  mock_group.return_value.apply_async.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_relay_polls_only_when_drained():
+  rounds = [outbox.OUTBOX_BATCH_SIZE, 3, asyncio.CancelledError()]
+  with patch("app.outbox.relayOrderOutbox", new_callable=AsyncMock) as mock_relay, \
+       patch("app.outbox.asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+    mock_relay.side_effect = rounds
+    with pytest.raises(asyncio.CancelledError):
+      await outbox.relay()
+
+  assert mock_relay.call_count == 3
+  mock_sleep.assert_called_once_with(outbox.OUTBOX_POLL_INTERVAL)
@@ -0,0 +1,37 @@
+import uuid
+import pytest
+from app.partitions import jump_hash, order_partition, order_queue, parse_partitions
+from app.celery_app import route_order
+
+
+def test_jump_hash_moves_keys_only_to_new_bucket():
+  keys = range(10000)
+  before = [jump_hash(k, 8) for k in keys]
+  after = [jump_hash(k, 9) for k in keys]
+  moved = [(b, a) for b, a in zip(before, after) if b != a]
+  assert all(0 <= b < 8 for b in before)
+  assert all(a == 8 for _, a in moved)
+  # About 1/9 of the keys move
+  assert 800 < len(moved) < 1450
+
+
+def test_order_partition_is_stable_per_product():
+  productId = str(uuid.uuid4())
+  assert order_partition(productId, 8) == order_partition(productId.upper(), 8)
+  assert order_queue(productId, 8) == f"orders.{order_partition(productId, 8)}"
+  assert order_partition(productId, 1) == 0
+
+
+def test_parse_partitions():
+  assert parse_partitions("", 4) == [0, 1, 2, 3]
+  assert parse_partitions("0-2, 5", 8) == [0, 1, 2, 5]
+  with pytest.raises(ValueError):
+    parse_partitions("7-8", 8)
+
+
+def test_route_order():
+  productId = str(uuid.uuid4())
+  assert route_order("app.tasks.processOrder", ["order_1", productId], {}, {}) == {"queue": order_queue(productId)}
+  assert route_order("app.tasks.processOrder", ["order_1"], {"productId": productId}, {}) == {"queue": order_queue(productId)}
+  assert route_order("app.tasks.processOrder", ["order_1"], {}, {}) is None
+  assert route_order("app.tasks.drainPendingOrders", [], {}, {}) is None
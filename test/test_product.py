@@ -1,8 +1,13 @@
+import asyncio
+import gzip
+import time
 import pytest
 from datetime import datetime
 from httpx import AsyncClient, ASGITransport
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, MagicMock
 from app.model import Product
+from app.config import _read_primary
+from app.cache import SingleFlight, product_l1, invalidate_product, get_or_load, product_key
 
 from app.main import app
 
@@ -14,7 +19,8 @@ async def test_add_product():
     "price": 100,
     "stock": 50
   }
-  with patch("app.routers.products.addProduct", new_callable=AsyncMock) as mock_add_product:
+  with patch("app.routers.products.addProduct", new_callable=AsyncMock) as mock_add_product, \
+    patch("app.routers.products.invalidate_product", new_callable=AsyncMock):
 
     mock_add_product.return_value = mock_return_data
 
@@ -80,10 +86,11 @@ async def test_get_products():
   ]
   
   with patch("app.routers.products.getProducts", new_callable=AsyncMock) as mock_get_products, \
-    patch("app.routers.products.rd") as mock_redis:
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
     
     mock_get_products.return_value = mock_products
-    mock_redis.get.return_value = None
+    mock_cache_get.return_value = None
     
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
@@ -111,10 +118,11 @@ async def test_get_product_by_id():
   )
   
   with patch("app.routers.products.getProductById", new_callable=AsyncMock) as mock_get_product, \
-    patch("app.routers.products.rd") as mock_redis:
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
     
     mock_get_product.return_value = mock_product
-    mock_redis.get.return_value = None
+    mock_cache_get.return_value = None
     
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
@@ -133,9 +141,10 @@ async def test_get_product_by_id():
 @pytest.mark.anyio
 async def test_get_product_by_id_not_found():
   with patch("app.routers.products.getProductById", new_callable=AsyncMock) as mock_get_product, \
-   patch("app.routers.products.rd") as mock_redis:
+   patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
     mock_get_product.return_value = None
-    mock_redis.get.return_value = None
+    mock_cache_get.return_value = None
     
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
@@ -148,7 +157,8 @@ async def test_get_product_by_id_not_found():
 
 @pytest.mark.anyio
 async def test_update_product():
-  with patch("app.routers.products.updateProduct", new_callable=AsyncMock) as mock_update_product:
+  with patch("app.routers.products.updateProduct", new_callable=AsyncMock) as mock_update_product, \
+    patch("app.routers.products.invalidate_product", new_callable=AsyncMock) as mock_invalidate:
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
     ) as ac:
@@ -164,6 +174,7 @@ async def test_update_product():
     assert response.status_code == 200
     assert response.json() == {"message": "Product updated successfully"}
     mock_update_product.assert_called_once()
+    mock_invalidate.assert_called_once_with("019b9605-51cb-763f-bfdd-db992540da8a")
 
 
 @pytest.mark.anyio
@@ -188,7 +199,8 @@ async def test_update_product_failure():
 
 @pytest.mark.anyio
 async def test_delete_product():
-  with patch("app.routers.products.deleteProduct", new_callable=AsyncMock) as mock_delete_product:
+  with patch("app.routers.products.deleteProduct", new_callable=AsyncMock) as mock_delete_product, \
+    patch("app.routers.products.invalidate_product", new_callable=AsyncMock) as mock_invalidate:
     async with AsyncClient(
       transport=ASGITransport(app=app), base_url="http://localhost:8000"
     ) as ac:
@@ -197,6 +209,7 @@ async def test_delete_product():
     assert response.status_code == 200
     assert response.json() == {"message": "product deleted successfully"}
     mock_delete_product.assert_called_once_with(productId="prod_123")
+    mock_invalidate.assert_called_once_with("prod_123")
 
 
 @pytest.mark.anyio
@@ -209,4 +222,320 @@ async def test_delete_product_failure():
     ) as ac:
       response = await ac.delete("/api/v1/products/prod_123")
     
-    assert response.status_code == 500
\ No newline at end of file
+    assert response.status_code == 500
+
+@pytest.mark.anyio
+async def test_get_products_cursor():
+  created_at = datetime(2025, 1, 8, 10, 0, 0)
+  mock_products: list[Product] = [
+    Product(
+      id="019b96e9-27af-75a4-a4c8-12755693b966",
+      name="kapas",
+      price=10000,
+      stock=100,
+      created_at=created_at
+    )
+  ]
+
+  with patch("app.routers.products.getProducts", new_callable=AsyncMock) as mock_get_products, \
+    patch("app.routers.products.getProductsAfter", new_callable=AsyncMock) as mock_get_after, \
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
+
+    mock_get_products.return_value = mock_products
+    mock_get_after.return_value = []
+    mock_cache_get.return_value = None
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      first = await ac.get("/api/v1/products/?per_page=1")
+      cursor = first.json()["next_cursor"]
+      second = await ac.get(f"/api/v1/products/?per_page=1&cursor={cursor}")
+
+    assert first.status_code == 200
+    assert cursor is not None
+    assert second.status_code == 200
+    assert second.json() == {"data": [], "next_cursor": None}
+    mock_get_after.assert_called_once_with(
+      created_at=created_at, productId="019b96e9-27af-75a4-a4c8-12755693b966", per_page=1
+    )
+
+
+@pytest.mark.anyio
+async def test_get_products_invalid_cursor():
+  async with AsyncClient(
+    transport=ASGITransport(app=app), base_url="http://localhost:8000"
+  ) as ac:
+    response = await ac.get("/api/v1/products/?cursor=not-a-cursor")
+
+  assert response.status_code == 400
+  assert response.json()["detail"] == "Invalid cursor"
+
+
+@pytest.mark.anyio
+async def test_bulk_add_products():
+  body = "\n".join([
+    '{"name": "kapas", "price": 10000, "stock": 100}',
+    '{"name": "batu", "price": "mahal", "stock": 1}',
+    '{"name": "kayu", "price": 500, "stock": 7}',
+  ])
+  with patch("app.routers.products.bulkAddProducts", new_callable=AsyncMock) as mock_bulk, \
+    patch("app.routers.products.invalidate_product", new_callable=AsyncMock) as mock_invalidate:
+    mock_bulk.side_effect = lambda products: len(products)
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/products/bulk",
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"}
+      )
+
+    assert response.status_code == 201
+    data = response.json()
+    assert data["inserted"] == 2
+    assert data["rejected"] == 1
+    assert data["chunks"][0]["errors"][0]["line"] == 2
+    products = mock_bulk.call_args.kwargs["products"]
+    assert [p.name for p in products] == ["kapas", "kayu"]
+    mock_invalidate.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_bulk_add_products_csv():
+  body = "name,price,stock\nkapas,10000,100\nbatu,10,\n"
+  with patch("app.routers.products.bulkAddProducts", new_callable=AsyncMock) as mock_bulk, \
+    patch("app.routers.products.invalidate_product", new_callable=AsyncMock):
+    mock_bulk.side_effect = lambda products: len(products)
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/products/bulk",
+        content=body,
+        headers={"Content-Type": "text/csv"}
+      )
+
+    assert response.status_code == 201
+    assert response.json()["inserted"] == 1
+    assert response.json()["rejected"] == 1
+
+
+@pytest.mark.anyio
+async def test_bulk_add_products_invalid_rows_close_chunks():
+  body = "\n".join(["not json"] * 50)
+  with patch("app.routers.products.IMPORT_CHUNK_SIZE", 20), \
+    patch("app.routers.products.MAX_ERRORS_PER_CHUNK", 3), \
+    patch("app.routers.products.bulkAddProducts", new_callable=AsyncMock) as mock_bulk:
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/products/bulk",
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"}
+      )
+
+    assert response.status_code == 201
+    data = response.json()
+    assert data["rejected"] == 50
+    assert [c["invalid"] for c in data["chunks"]] == [20, 20, 10]
+    assert all(len(c["errors"]) == 3 for c in data["chunks"])
+    mock_bulk.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_bulk_add_products_csv_multiline_and_bad_rows():
+  body = b"".join([
+    b"name,price,stock\n",
+    b'"kapas\nputih",10000,100\n',
+    b"batu,-10,1\n",
+    b"\xffkayu,500,7\n",
+    b"x" * 100 + b",1,1\n",
+    b"besi,500,7\n",
+  ])
+  with patch("app.routers.products.MAX_LINE_BYTES", 64), \
+    patch("app.routers.products.bulkAddProducts", new_callable=AsyncMock) as mock_bulk, \
+    patch("app.routers.products.invalidate_product", new_callable=AsyncMock):
+    mock_bulk.side_effect = lambda products: len(products)
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      response = await ac.post(
+        "/api/v1/products/bulk",
+        content=body,
+        headers={"Content-Type": "text/csv"}
+      )
+
+    assert response.status_code == 201
+    data = response.json()
+    assert data["inserted"] == 2
+    # Negative price, undecodable bytes and the overlong line, by first line
+    assert [e["line"] for e in data["chunks"][0]["errors"]] == [4, 5, 6]
+    products = mock_bulk.call_args.kwargs["products"]
+    assert [p.name for p in products] == ["kapas\nputih", "besi"]
+
+
+@pytest.mark.anyio
+async def test_get_product_by_id_local_cache():
+  mock_product = Product(
+    id="019b96e9-27af-75a4-a4c8-12755693b966",
+    name="kapas",
+    price=10000,
+    stock=100,
+    created_at=datetime.now()
+  )
+  product_l1.clear()
+
+  with patch("app.routers.products.getProductById", new_callable=AsyncMock) as mock_get_product, \
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock), \
+    patch("app.cache.Cache.client") as mock_client:
+
+    mock_get_product.return_value = mock_product
+    mock_cache_get.return_value = None
+    mock_client.return_value.pipeline.side_effect = Exception("redis down")
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      first = await ac.get("/api/v1/products/019b96e9-27af-75a4-a4c8-12755693b966")
+      second = await ac.get("/api/v1/products/019b96e9-27af-75a4-a4c8-12755693b966")
+      await invalidate_product("019b96e9-27af-75a4-a4c8-12755693b966")
+      third = await ac.get("/api/v1/products/019b96e9-27af-75a4-a4c8-12755693b966")
+
+    assert first.json() == second.json() == third.json()
+    # Two Redis lookups, each miss also reading the key's tombstone
+    assert mock_cache_get.call_count == 4
+    assert mock_get_product.call_count == 2
+    assert product_l1.hits == 1
+
+  product_l1.clear()
+
+
+@pytest.mark.anyio
+async def test_invalidated_key_refuses_racing_fill():
+  key = product_key("019b96e9-27af-75a4-a4c8-12755693b966")
+  pipe = MagicMock()
+  pipe.execute = AsyncMock()
+  client = MagicMock()
+  client.pipeline.return_value.__aenter__.return_value = pipe
+
+  with patch("app.cache.Cache.client", return_value=client), \
+    patch("app.cache.CACHE_TOMBSTONE_TTL", 10), \
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock) as mock_cache_setex:
+    mock_cache_get.side_effect = lambda k: b"1:earlier-write" if k == f"tombstone:{key}" else None
+
+    async def load():
+      # The write lands while the row is being read
+      await invalidate_product("019b96e9-27af-75a4-a4c8-12755693b966")
+      return b"old row"
+
+    assert await get_or_load(key, load) == b"old row"
+
+  pipe.delete.assert_called_once_with(key)
+  tombstone, stamp = pipe.set.call_args_list[0].args
+  assert tombstone == f"tombstone:{key}"
+  assert pipe.set.call_args.kwargs["px"] == 10000
+  # The fill is conditioned on the tombstone it saw, which the write replaced
+  assert mock_cache_setex.call_args.kwargs["tombstone"] == tombstone
+  assert mock_cache_setex.call_args.kwargs["seen"] == b"1:earlier-write"
+  assert stamp.encode() != b"1:earlier-write"
+
+
+@pytest.mark.anyio
+async def test_recently_written_key_fills_from_primary():
+  key = product_key("019b96e9-27af-75a4-a4c8-12755693b966")
+  stamp = f"{time.time_ns()}:abcd1234".encode()
+
+  async def load():
+    return b"primary" if _read_primary.get() else b"replica"
+
+  with patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock):
+    # A tombstone from a write inside READ_YOUR_WRITES_WINDOW pins the fill
+    mock_cache_get.side_effect = lambda k: stamp if k.startswith("tombstone:") else None
+    assert await asyncio.create_task(get_or_load(key, load)) == b"primary"
+
+    # An old one, or none, leaves the fill on the replicas
+    mock_cache_get.side_effect = lambda k: b"1:abcd1234" if k.startswith("tombstone:") else None
+    assert await asyncio.create_task(get_or_load(key, load)) == b"replica"
+
+
+@pytest.mark.anyio
+async def test_get_products_single_flight():
+  async def slow_products(page, per_page):
+    await asyncio.sleep(0.05)
+    return []
+
+  with patch("app.routers.products.getProducts", new_callable=AsyncMock) as mock_get_products, \
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get, \
+    patch("app.cache.Cache.setex", new_callable=AsyncMock) as mock_cache_setex:
+
+    mock_get_products.side_effect = slow_products
+    mock_cache_get.return_value = None
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      responses = await asyncio.gather(
+        *(ac.get("/api/v1/products/?page=1&per_page=10") for _ in range(10))
+      )
+
+    assert all(r.status_code == 200 for r in responses)
+    assert all(r.json() == {"data": [], "next_cursor": None} for r in responses)
+    mock_get_products.assert_called_once_with(page=1, per_page=10)
+    mock_cache_setex.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_single_flight_survives_leader_cancellation():
+  flight = SingleFlight()
+  release = asyncio.Event()
+
+  async def load():
+    await release.wait()
+    return b"row"
+
+  leader = asyncio.create_task(flight.do("product:1", load))
+  await asyncio.sleep(0)
+  follower = asyncio.create_task(flight.do("product:1", load))
+  await asyncio.sleep(0)
+
+  # The leader's client goes away; the follower still gets the row
+  leader.cancel()
+  release.set()
+  assert await follower == b"row"
+  with pytest.raises(asyncio.CancelledError):
+    await leader
+  assert not flight.running("product:1")
+
+
+@pytest.mark.anyio
+async def test_get_products_cache_hit():
+  body = gzip.compress(b'{"data":[{"id":"019b96e9-27af-75a4-a4c8-12755693b966","name":"kapas"}],"next_cursor":null}')
+
+  with patch("app.routers.products.getProducts", new_callable=AsyncMock) as mock_get_products, \
+    patch("app.cache.Cache.get", new_callable=AsyncMock) as mock_cache_get:
+
+    mock_cache_get.side_effect = lambda key: None if key.endswith(":gen") else body
+
+    async with AsyncClient(
+      transport=ASGITransport(app=app), base_url="http://localhost:8000"
+    ) as ac:
+      compressed = await ac.get("/api/v1/products/", headers={"Accept-Encoding": "gzip"})
+      plain = await ac.get("/api/v1/products/", headers={"Accept-Encoding": "identity"})
+
+    assert compressed.status_code == 200
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert "content-encoding" not in plain.headers
+    assert compressed.headers["vary"] == plain.headers["vary"] == "Accept-Encoding"
+    assert compressed.json() == plain.json()
+    assert plain.json()["data"][0]["name"] == "kapas"
+    mock_get_products.assert_not_called()